@@ -0,0 +1,108 @@
+from telebot import types
+import asyncio
+import atexit
+from bot_init import init_bot
+from config import *
+from database.client import *
+from database.usage_ledger import usage_ledger
+from utils.delayed_actions import delayed_deleter
+from utils.broadcast import broadcast_engine
+from utils.report_jobs import report_runner
+from utils.metrics import metrics_server
+from handlers import callback_handlers, message_handlers
+from handlers.ai_handlers import *
+from utils.logger import get_logger
+from utils.helpers import *
+from utils.subscription_checker import run_subscription_checks
+from utils.transport import create_ai_client, close_transport
+from webhook_server import run_webhook
+
+
+logger = get_logger(__name__)
+
+def shutdown_logger():
+    logger.info("⛔ Бот остановлен.")
+
+def flush_write_buffer():
+    # Если цикл завершился, не записав буфер, дописываем его синхронно
+    user_write_buffer.flush_sync()
+    usage_ledger.flush_sync()
+
+# Инициализация ИИ
+client_gpt = create_ai_client("openai", OPENAI_API_KEY)
+client_perplexity = create_ai_client("perplexity", PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
+client_deepseek = create_ai_client("deepseek", DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
+client_gemini = ""
+client_claude = ""
+client_midjourney = ""
+
+ai_handlers = {
+    "gpt-4o": {"client": client_gpt, "method":send_to_gpt, "provider": "openai", "stream": True},
+    "dalle3": {"client": client_gpt, "method":send_to_dalle, "provider": "openai"},
+    #perplexity
+    "sonar": {"client": client_perplexity, "method":send_to_perplexity, "provider": "perplexity", "stream": True},
+    "deepseek": {"client": client_deepseek, "method":send_to_deepseek, "provider": "deepseek", "stream": True},
+    # "gemini": {"client": client_gemini, "method":send_to_gemini},
+    # "claude": {"client": client_claude, "method":send_to_claude},
+    # "midjourney": {"client": client_midjourney, "method":send_to_midjourney},
+}
+
+
+# Установка боковой панели кнопок при старте бота
+async def setup_bot_commands(bot):
+    await bot.set_my_commands([
+        types.BotCommand(cmd, desc) for cmd, desc in SIDE_BUTTONS.items()
+    ])
+
+# --- Запуск бота ---
+def main():
+    atexit.register(shutdown_logger)
+    atexit.register(flush_write_buffer)
+
+    loop = asyncio.new_event_loop()
+    try:
+        bot = loop.run_until_complete(init_bot())
+
+        # Регистрируем хэндлеры с ботом
+        callback_handlers.register_handlers(bot, ai_handlers)
+        message_handlers.register_handlers(bot, ai_handlers)
+
+        # Настраиваем команды
+        loop.run_until_complete(setup_bot_commands(bot))
+
+        # Эндпоинт метрик для Prometheus
+        loop.run_until_complete(metrics_server.start())
+
+        # Возвращаем таймеры удаления сообщений и рассылки, оставшиеся с прошлого запуска
+        loop.run_until_complete(delayed_deleter.restore(bot))
+        loop.run_until_complete(broadcast_engine.resume(bot))
+
+        # Запускаем фоновую проверку подписок
+        loop.create_task(run_subscription_checks(bot))
+
+        # Фоновая запись отложенных обновлений пользователей и журнала расхода
+        loop.create_task(user_write_buffer.run())
+        loop.create_task(usage_ledger.run())
+
+        # Получаем обновления через webhook или polling
+        if BOT_MODE == "webhook":
+            loop.run_until_complete(run_webhook(bot))
+        else:
+            loop.run_until_complete(bot.polling(none_stop=True))
+    except Exception as e:
+        logger.error(f"⛔ Критическая ошибка: {e}")
+    finally:
+        # Рассылки продолжатся после запуска с сохранённого места
+        loop.run_until_complete(broadcast_engine.stop())
+        # Незавершённые отчёты отменяются, пул процессов закрывается
+        loop.run_until_complete(report_runner.shutdown())
+        # Дожидаемся фоновых записей истории и кэша, затем записываем отложенные обновления
+        loop.run_until_complete(wait_background_tasks())
+        loop.run_until_complete(user_write_buffer.flush())
+        loop.run_until_complete(usage_ledger.flush())
+        # Останавливаем таймеры удаления, несработавшие сохраняются в бд
+        loop.run_until_complete(delayed_deleter.stop())
+        loop.run_until_complete(metrics_server.stop())
+        # Закрываем пулы соединений к провайдерам
+        loop.run_until_complete(close_transport())
+        loop.close()
@@ -1,21 +1,31 @@
 from telebot.async_telebot import AsyncTeleBot
 from database.client import test_mongo_connection
+from database.indexes import run_migrations, report_index_coverage
 from config import TELEGRAM_TOKEN, set_bot_id
+from presets.registry import ROLE_REGISTRY, MODEL_REGISTRY
 from utils.logger import get_logger
+from utils.metrics import instrument_bot
 
 logger = get_logger(__name__)
 
 async def init_bot():
     bot = AsyncTeleBot(TELEGRAM_TOKEN)
+    instrument_bot(bot)
     try:
         me = await bot.get_me()
         set_bot_id(me.id)
         logger.info(f"🚀 Бот создан. {me.first_name} (@{me.username})")
+        logger.info(f"📚 Пресеты проверены: ролей {len(ROLE_REGISTRY)}, моделей {len(MODEL_REGISTRY)}")
 
         if not await test_mongo_connection():
             logger.error("❌ Ошибка при подключении к базе данных")
             exit(1)
 
+        # Индексы и миграции бд
+        if not await run_migrations():
+            logger.warning("⚠️ Не все миграции применены, часть запросов может работать без индексов")
+        await report_index_coverage()
+
         return bot
     except Exception as e:
         logger.error(f"❌ Ошибка при инициализации бота: {e}")
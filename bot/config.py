@@ -16,13 +16,23 @@ if not token or token.startswith("sk-") or len(token) < 35:
 
 BOT_ID = None
 
-# Глобальная переменная для хранения активных задач
-user_tasks = {}
-# Глобальная переменная для хранения состояний пользователей
-user_states = {}
+# Хранилище активных запросов и состояний диалогов: memory (один процесс) или mongo (несколько процессов)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+REQUEST_LEASE_TTL = int(os.getenv("REQUEST_LEASE_TTL", "300"))  # секунды, на случай падения процесса посреди запроса
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "600"))  # секунды, сколько ждём ввода после кнопки
 
 # Переменные окружения
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Способ получения обновлений: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://bot.example.com/telegram
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # обязателен для webhook: 1-256 символов A-Z, a-z, 0-9, _ и -
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # одновременных соединений от Telegram
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))  # секунды на обработку очереди при остановке
 ADMINS = [int(x.strip()) for x in os.getenv("TELEGRAM_ADMINS_ID", "").split(",") if x.strip()]
 AI_REQUEST_LIMIT = int(os.getenv("AI_REQUEST_LIMIT"))
 subscription_price_str = os.getenv("SUBSCRIPTION_PRICE", "150")
@@ -34,6 +44,100 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PERPLEXITY_API_KEY = os.getenv("PERPLEXITY_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
+# Кэш пользовательских документов
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "60"))  # секунды
+
+# Буфер последних реплик для сборки контекста
+HISTORY_BUFFER_USERS = int(os.getenv("HISTORY_BUFFER_USERS", "5000"))
+HISTORY_BUFFER_SIZE = int(os.getenv("HISTORY_BUFFER_SIZE", "20"))
+
+# Просмотр истории запросов постранично
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "2"))
+HISTORY_COUNT_TTL = int(os.getenv("HISTORY_COUNT_TTL", "600"))  # секунды хранения числа записей
+
+# Отложенная запись last_seen и счётчиков статистики
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL", "5"))  # секунды между записями в бд
+WRITE_BUFFER_MAX_USERS = int(os.getenv("WRITE_BUFFER_MAX_USERS", "1000"))  # при стольких пользователях пишем сразу
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "500"))  # записей журнала расхода в одной вставке
+
+# Отложенное удаление служебных сообщений
+DELAYED_DELETE_PERSIST_AFTER = float(os.getenv("DELAYED_DELETE_PERSIST_AFTER", "30"))  # с такой задержки таймер сохраняется в бд
+
+# Логирование: файл пишется в отдельном потоке, записи в формате JSON
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")  # уровни модулей: database.client=DEBUG,telebot=WARNING
+LOG_ROTATION = os.getenv("LOG_ROTATION", "size").lower()  # size или time
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(20 * 1024 * 1024)))  # размер файла при ротации по размеру
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")  # период при ротации по времени
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "7"))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))  # доля сохраняемых частых событий (sampled=True)
+
+# Напоминания о продлении подписки
+SUBSCRIPTION_CHECK_INTERVAL = int(os.getenv("SUBSCRIPTION_CHECK_INTERVAL", "3600"))  # секунды между проверками
+SUBSCRIPTION_CHECK_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_CHECK_BATCH_SIZE", "500"))  # пользователей в пачке курсора
+
+# Рассылки администратора
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду; лимит Telegram ~30, часть оставляем на ответы
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))  # одновременных отправок
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))  # пользователей между сохранениями прогресса
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))  # секунды между обновлениями прогресса
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))  # повторов после 429
+BROADCAST_HEARTBEAT_INTERVAL = float(os.getenv("BROADCAST_HEARTBEAT_INTERVAL", "30"))  # секунды между отметками владельца
+BROADCAST_OWNER_TTL = float(os.getenv("BROADCAST_OWNER_TTL", "120"))  # секунды без отметки, после которых рассылку можно забрать
+
+# Выгрузка таблиц для администратора
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))  # записей в пачке курсора
+EXPORT_XLSX_MAX_ROWS = int(os.getenv("EXPORT_XLSX_MAX_ROWS", "20000"))  # больше строк — выгрузка в CSV.gz
+EXPORT_PART_MAX_BYTES = int(os.getenv("EXPORT_PART_MAX_BYTES", str(45 * 1024 * 1024)))  # Telegram принимает файлы до 50 МБ
+
+# Отчёты администратора
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))  # процессов для построения файлов
+REPORT_MAX_JOBS = int(os.getenv("REPORT_MAX_JOBS", "2"))  # отчётов, формируемых одновременно
+REPORT_QUEUE_SIZE = int(os.getenv("REPORT_QUEUE_SIZE", "10"))  # отчётов, ожидающих в очереди
+
+# Метрики Prometheus на локальном эндпоинте /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Потоковый вывод ответов ИИ
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # секунды между правками сообщения
+
+# Пулы HTTP-соединений к провайдерам
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+HTTP_MAX_CONNECTIONS_PER_HOST = int(os.getenv("HTTP_MAX_CONNECTIONS_PER_HOST", "100"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))  # секунды
+
+# Маршрутизация запросов между провайдерами
+ROUTER_HEDGING = os.getenv("ROUTER_HEDGING", "true").lower() in ("1", "true", "yes")
+ROUTER_HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", "2.0"))  # секунды
+ROUTER_FAILURE_THRESHOLD = int(os.getenv("ROUTER_FAILURE_THRESHOLD", "3"))  # ошибок подряд до отключения
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "30"))  # секунды
+ROUTER_FALLBACK_FOR_SUBSCRIBERS = os.getenv("ROUTER_FALLBACK_FOR_SUBSCRIBERS", "false").lower() in ("1", "true", "yes")
+
+# Очередь запросов к провайдерам: одновременные запросы и токены в минуту (0 — без ограничения)
+PROVIDER_MAX_CONCURRENCY = {
+    "openai": int(os.getenv("OPENAI_MAX_CONCURRENCY", "20")),
+    "perplexity": int(os.getenv("PERPLEXITY_MAX_CONCURRENCY", "10")),
+    "deepseek": int(os.getenv("DEEPSEEK_MAX_CONCURRENCY", "10")),
+}
+PROVIDER_TOKENS_PER_MINUTE = {
+    "openai": int(os.getenv("OPENAI_TOKENS_PER_MINUTE", "0")),
+    "perplexity": int(os.getenv("PERPLEXITY_TOKENS_PER_MINUTE", "0")),
+    "deepseek": int(os.getenv("DEEPSEEK_TOKENS_PER_MINUTE", "0")),
+}
+SUBSCRIBER_QUEUE_WEIGHT = float(os.getenv("SUBSCRIBER_QUEUE_WEIGHT", "3"))  # во сколько раз подписчики продвигаются быстрее
+QUEUE_POSITION_INTERVAL = float(os.getenv("QUEUE_POSITION_INTERVAL", "2.0"))  # секунды между сообщениями о месте в очереди
+
+# Кэш ответов ИИ для повторяющихся запросов
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "5000"))
+RESPONSE_CACHE_DEFAULT_TTL = int(os.getenv("RESPONSE_CACHE_DEFAULT_TTL", "0"))  # секунды для ролей без cache_ttl, 0 — не кэшировать
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.85"))  # роли с temperature не ниже не кэшируются
+RESPONSE_CACHE_MONGO = os.getenv("RESPONSE_CACHE_MONGO", "false").lower() in ("1", "true", "yes")
+
 # Проверяем, что это действительно число
 if subscription_price_str.strip() == "":
     SUBSCRIPTION_PRICE = 150
@@ -43,6 +147,18 @@ else:
     except ValueError:
         raise ValueError("SUBSCRIPTION_PRICE должен быть целым числом")
 
+if STATE_BACKEND not in ("memory", "mongo"):
+    raise ValueError("STATE_BACKEND должен быть memory или mongo")
+if BOT_MODE not in ("polling", "webhook"):
+    raise ValueError("BOT_MODE должен быть polling или webhook")
+if BOT_MODE == "webhook" and not WEBHOOK_URL.startswith("https://"):
+    raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_URL с https://")
+# Без секрета любой, кто узнал адрес webhook, может прислать поддельное обновление от имени админа
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    raise ValueError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET")
+if LOG_ROTATION not in ("size", "time"):
+    raise ValueError("LOG_ROTATION должен быть size или time")
+
 
 # Текста
 WELCOME_MESSAGE = messages.WELCOME_MESSAGE
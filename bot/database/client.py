@@ -1,18 +1,68 @@
+import logging
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from cachetools import LRUCache, TTLCache
+from collections import deque
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from config import *
 from utils.logger import get_logger
+from utils.tokens import count_tokens
+from database.write_buffer import UserWriteBuffer
+from utils.metrics import MongoCommandMetrics
+from presets.registry import get_role, build_system_prompt, CUSTOM_ROLE_KEY
 
 load_dotenv()
 
 
-client = AsyncIOMotorClient(MONGODB_BOT_URI)
+# Все команды к бд замеряются для метрик
+client = AsyncIOMotorClient(MONGODB_BOT_URI, event_listeners=[MongoCommandMetrics()])
 db = client[MONGODB_DB_NAME]
 users_collection = db["users"]
 history_collection = db["history"]
 logger = get_logger(__name__)
 
+
+class NoCache(dict):
+    """Кэш, который ничего не запоминает: чтение всегда промахивается и идёт в бд."""
+
+    def __setitem__(self, key, value):
+        pass
+
+
+def local_cache(cache):
+    """
+    Кэши ниже живут в памяти процесса и сбрасываются только его собственными записями.
+    С STATE_BACKEND=mongo бот работает в нескольких процессах, и изменения, сделанные другим
+    процессом (модель, роль, подписка, очистка истории), здесь не были бы видны — поэтому
+    в этом режиме кэши отключены и данные читаются из бд.
+    """
+    return cache if STATE_BACKEND == "memory" else NoCache()
+
+
+# Кэш документов пользователей: user_id -> документ из бд.
+# Любая запись в users_collection должна сбрасывать запись кэша (см. update_user)
+user_cache = local_cache(TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL))
+# Дата, когда документ в кэше прошёл полную синхронизацию в ensure_user_exists.
+# В тот же день повторная синхронизация ничего не изменит, кроме last_seen
+user_sync_dates = local_cache(TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL))
+
+# Отложенная запись last_seen и счётчиков статистики
+user_write_buffer = UserWriteBuffer(users_collection)
+
+# Последние реплики активных пользователей: user_id -> deque в хронологическом порядке.
+# Пополняется в save_query_to_history, поэтому сборка контекста не ходит в бд
+history_buffers = local_cache(LRUCache(maxsize=HISTORY_BUFFER_USERS))
+# Число записей истории пользователя для подписи страниц: user_id -> количество.
+# Поддерживается в save_query_to_history и clear_user_history, поэтому count_documents выполняется редко
+history_counts = local_cache(TTLCache(maxsize=HISTORY_BUFFER_USERS, ttl=HISTORY_COUNT_TTL))
+HISTORY_WINDOW_PROJECTION = {
+    "_id": 0, "query": 1, "response": 1, "timestamp": 1, "query_tokens": 1, "response_tokens": 1
+}
+
+# Роли, доступные без подписки
+FREE_ROLES = ["tarot_reader", "compatibility", "numerologist"]
+
 DEFAULT_USER_DATA = {
     "is_subscribed": False,
     "subscription_start": "",
@@ -41,135 +91,210 @@ async def test_mongo_connection():
     except Exception as e:
         logger.error(f"❌ Не удалось подключиться: {e}")
         return False
-    
 
-# Проверка, есть ли пользователь в базе
+
+def invalidate_user_cache(user_id):
+    user_cache.pop(user_id, None)
+    user_sync_dates.pop(user_id, None)
+
+
+async def update_user(user_id, update):
+    """Обновляет документ пользователя и сбрасывает его кэш."""
+    result = await users_collection.update_one({"user_id": user_id}, update)
+    invalidate_user_cache(user_id)
+    return result
+
+
+# Проверка, есть ли пользователь в базе.
+# Одним атомарным upsert'ом создаёт пользователя или приводит его документ
+# в актуальное состояние и возвращает результат
 async def ensure_user_exists(user):
     # игнорирование бота как пользователя
     user_id = user.id
     if user_id == BOT_ID:
-        return
+        return None
 
-    logger.info(f"👤 Проверка пользователя:\n ID:{user.id}\n FirstName:{user.first_name}\n LastName:{user.last_name}\n Username:{user.username}\n LangCode:{user.language_code}\n PremiumSub:{user.is_premium}")  
-    now = datetime.now()
-    user_data = await users_collection.find_one({"user_id": user_id})
-
-    # Если пользователя нет — создаём его в бд
-    if not user_data:
-        request_limits = {key: {"count": 0} for key in AI_PRESETS.keys()}
-        monthly_usage = {key: 0 for key in AI_PRESETS.keys()}
-
-        new_user_data = DEFAULT_USER_DATA.copy()
-        new_user_data.update({
-            "user_id": user_id,
-            "first_name": user.first_name,
+    # Вызывается на каждое сообщение, поэтому пишем только выборку и только на уровне DEBUG
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("👤 Проверка пользователя", extra={
+            "user_id": user.id,
             "username": user.username,
-            "registered_at": now,
-            "last_seen": now,
-            "request_limits": request_limits,
-            "monthly_usage": monthly_usage
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+            "language_code": user.language_code,
+            "is_premium": user.is_premium,
+            "sampled": True,
         })
-        
-        await users_collection.insert_one(new_user_data)
-        return
+    now = datetime.now()
 
-    logger.info(f"👤 UserName пользователя из бд: {user_data.get("username", "Не выявлено")}")
-    is_subscribed = user_data.get("is_subscribed", False)
-    
-    # Обновление полей у пользователей в бд
-    update_data = {}
-    
-    for field, default_value in DEFAULT_USER_DATA.items():
-        if field not in user_data:
-            update_data[field] = default_value
+    # Сегодня документ уже синхронизирован и с тех пор не менялся — обновляем только last_seen
+    user_data = user_cache.get(user_id)
+    if user_data is not None and user_sync_dates.get(user_id) == now.date():
+        user_data["last_seen"] = now
+        user_write_buffer.max(user_id, {"last_seen": now})
+        return user_data
 
-    if update_data:
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": update_data}
-        )
+    tomorrow = datetime(now.year, now.month, now.day) + timedelta(days=1)
+    user_data = await users_collection.find_one_and_update(
+        {"user_id": user_id},
+        build_user_sync_pipeline(user, now, tomorrow),
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    user_cache[user_id] = user_data
+    user_sync_dates[user_id] = now.date()
+    return user_data
+
+
+def build_user_sync_pipeline(user, now, tomorrow):
+    """
+    Pipeline-обновление документа пользователя, которое выполняется на стороне MongoDB:
+    значения по умолчанию, подписка админов, истечение подписки,
+    сброс настроек без подписки, сброс лимитов в новом месяце и last_seen.
+    """
+    # Заполняем отсутствующие поля значениями по умолчанию
+    defaults = {
+        field: {"$ifNull": [f"${field}", {"$literal": default_value}]}
+        for field, default_value in DEFAULT_USER_DATA.items()
+    }
+    # Имя и username задаёт пользователь: строка вида "$cash" без $literal была бы путём к полю
+    defaults.update({
+        "first_name": {"$ifNull": ["$first_name", {"$literal": user.first_name}]},
+        "username": {"$ifNull": ["$username", {"$literal": user.username}]},
+        "registered_at": {"$ifNull": ["$registered_at", now]},
+        # Пользователь написал боту — значит, больше не блокирует его, рассылки снова доходят
+        "is_blocked": False,
+    })
+    pipeline = [{"$set": defaults}]
 
     # Выдача подписки админам
-    if user_id in ADMINS:
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"is_subscribed": True, "subscription_end": None}}  # Без ограничения по времени
-        )
-
-    subscription_end = user_data.get("subscription_end", None)
-
-    if subscription_end == "":
-        subscription_end = None
-    elif isinstance(subscription_end, str):
-        try:
-            # Преобразуем строку в объект datetime
-            subscription_end = datetime.fromisoformat(subscription_end)
-        except ValueError:
-            logger.warning(f"[DEBUG] Некорректный формат даты у пользователя {user_id}")
-            logger.warning(f"[DEBUG] subscription_end: {subscription_end} | Тип: {type(subscription_end)}")
-            subscription_end = None
-
-    # Отключение подписки если истек ее срок
-    if (subscription_end is not None) and (now.date() == subscription_end.date()):
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"is_subscribed": False}}
-        )
-        is_subscribed = False
-
-    current_role = user_data.get("role")
-    if current_role not in  ["tarot_reader", "compatibility", "numerologist"]: current_role = "tarot_reader"
+    if user.id in ADMINS:
+        pipeline.append({"$set": {"is_subscribed": True, "subscription_end": None}})  # Без ограничения по времени
+
+    # subscription_end может храниться как datetime, ISO-строка или ""
+    subscription_end = {
+        "$convert": {"input": "$subscription_end", "to": "date", "onError": None, "onNull": None}
+    }
+
+    # Отключение подписки, если ее срок истекает сегодня или уже истёк
+    pipeline.append({"$set": {
+        "is_subscribed": {"$cond": [
+            {"$and": [
+                {"$ne": [subscription_end, None]},
+                {"$lt": [subscription_end, tomorrow]}
+            ]},
+            False,
+            "$is_subscribed"
+        ]}
+    }})
+
     # Если нет подписки - все сбрасывается по умолчанию
-    if not is_subscribed:
-        await users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"ai_model": "gpt-4o", "role":current_role, "subscription_start":"", "subscription_end":""}}
-    )
-        
-    # Сбрасываем лимиты в начале нового месяца
-    if user_data.get("last_month", None) != now.month:
-        model_limit = {"count":0}
-
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {
-                "$set": {
-                    "last_month": now.month,
-                    "monthly_usage": {model_key: 0 for model_key in AI_PRESETS.keys()},
-                    "request_limits": {model_key: model_limit for model_key in AI_PRESETS.keys()}
-                    
-                }
-            }
-        )
-            
-    # Обновляем дату последнего взаимодействия
-    await users_collection.update_one(
-        {"user_id": user_id},
-        {"$set": {"last_seen": now}}
-    )
-    
+    pipeline.append({"$set": {
+        "ai_model": {"$cond": ["$is_subscribed", "$ai_model", "gpt-4o"]},
+        "role": {"$cond": [
+            {"$or": ["$is_subscribed", {"$in": ["$role", FREE_ROLES]}]},
+            "$role",
+            "tarot_reader"
+        ]},
+        "subscription_start": {"$cond": ["$is_subscribed", "$subscription_start", ""]},
+        "subscription_end": {"$cond": ["$is_subscribed", "$subscription_end", ""]},
+    }})
+
+    # Сбрасываем лимиты в начале нового месяца и обновляем дату последнего взаимодействия
+    is_new_month = {"$ne": ["$last_month", now.month]}
+    pipeline.append({"$set": {
+        "monthly_usage": {"$cond": [
+            is_new_month,
+            {"$literal": {model_key: 0 for model_key in AI_PRESETS.keys()}},
+            "$monthly_usage"
+        ]},
+        "request_limits": {"$cond": [
+            is_new_month,
+            {"$literal": {model_key: {"count": 0} for model_key in AI_PRESETS.keys()}},
+            "$request_limits"
+        ]},
+        "last_month": now.month,
+        "last_seen": now,
+    }})
+
+    return pipeline
+
 
 async def get_all_users():
     cursor = users_collection.find()
     return await cursor.to_list(length=None)
 
 
-async def get_user_history(user_id):
-    cursor = history_collection.find({"user_id": user_id}, {"_id": 0})
-    return await cursor.to_list(length=100)
+async def get_history_page(user_id, limit, before=None, after=None):
+    """
+    Одна страница истории, от новых записей к старым. Курсор страницы — timestamp записи:
+    before — записи старше него (следующая страница), after — новее (предыдущая).
+    Читается по индексу user_id_timestamp не больше limit записей.
+    """
+    query = {"user_id": user_id}
+    if after is not None:
+        query["timestamp"] = {"$gt": after}
+        cursor = history_collection.find(query, {"_id": 0, "query": 1, "response": 1, "timestamp": 1})
+        entries = await cursor.sort("timestamp", 1).limit(limit).to_list(length=limit)
+        entries.reverse()
+        return entries
+
+    if before is not None:
+        query["timestamp"] = {"$lt": before}
+    cursor = history_collection.find(query, {"_id": 0, "query": 1, "response": 1, "timestamp": 1})
+    return await cursor.sort("timestamp", -1).limit(limit).to_list(length=limit)
+
+
+async def get_history_count(user_id):
+    count = history_counts.get(user_id)
+    if count is None:
+        count = await history_collection.count_documents({"user_id": user_id})
+        history_counts[user_id] = count
+    return count
+
+
+async def get_history_window(user_id, limit):
+    """Возвращает последние limit записей истории в хронологическом порядке."""
+    if limit <= 0:
+        return []
+
+    buffer = history_buffers.get(user_id)
+    if buffer is not None and limit <= buffer.maxlen:
+        return list(buffer)[-limit:]
+
+    size = max(limit, HISTORY_BUFFER_SIZE)
+    cursor = history_collection.find(
+        {"user_id": user_id}, HISTORY_WINDOW_PROJECTION
+    ).sort("timestamp", -1).limit(size)
+    entries = await cursor.to_list(length=size)
+    entries.reverse()
+
+    history_buffers[user_id] = deque(entries, maxlen=size)
+    return entries[-limit:]
 
 
 async def save_query_to_history(user_id, query, response):
-    await history_collection.insert_one({
+    entry = {
         "user_id": user_id,
         "query": query,
         "response": response,
-        "timestamp": datetime.now()
-    })
+        "timestamp": datetime.now(),
+        # Размер в токенах храним рядом с записью, чтобы не пересчитывать при сборке контекста
+        "query_tokens": count_tokens(query),
+        "response_tokens": count_tokens(response)
+    }
+    await history_collection.insert_one(entry)
+
+    if user_id in history_counts:
+        history_counts[user_id] += 1
+
+    buffer = history_buffers.get(user_id)
+    if buffer is not None:
+        buffer.append({field: entry[field] for field in HISTORY_WINDOW_PROJECTION if field in entry})
 
 
 async def is_user_subscribed(user_id):
-    user_data = await users_collection.find_one({"user_id": user_id})
+    user_data = await get_user_info(user_id)
     if not user_data:
         return False
     
@@ -180,42 +305,77 @@ async def is_user_subscribed(user_id):
     return user_data.get("is_subscribed", False)
 
 
-async def get_all_users_with_subscription():
-    try:
-        cursor = users_collection.find({
+async def iter_expiring_subscriptions(start, end):
+    """
+    Пользователи, чья подписка заканчивается в промежутке [start, end).
+    Читаются курсором пачками по индексу active_subscriptions, без загрузки всего списка в память.
+    """
+    cursor = users_collection.find(
+        {
             "is_subscribed": True,
-            "subscription_end": {"$ne": None},  # только с датой окончания
+            "subscription_end": {"$gte": start, "$lt": end},
             "user_id": {"$ne": BOT_ID}  # исключаем самого бота
-        })
-        users = await cursor.to_list(length=None)
-        return users
-    except Exception as e:
-        logger.error(f"❌ Ошибка при получении пользователей с подпиской: {e}")
-        return []
+        },
+        {"_id": 0, "user_id": 1, "subscription_end": 1, "last_seen": 1, "renewal_notified_for": 1},
+        batch_size=SUBSCRIPTION_CHECK_BATCH_SIZE
+    )
+    async for user_data in cursor:
+        yield user_data
+
+
+async def claim_renewal_notice(user_id, subscription_end):
+    """
+    Отмечает, что напоминание о продлении подписки с этой датой окончания отправлено.
+    Возвращает False, если отметка уже стоит — например, её поставил другой экземпляр бота или прошлый запуск.
+    """
+    result = await users_collection.update_one(
+        {"user_id": user_id, "renewal_notified_for": {"$ne": subscription_end}},
+        {"$set": {"renewal_notified_for": subscription_end}}
+    )
+    invalidate_user_cache(user_id)
+    return result.modified_count == 1
+
+
+async def release_renewal_notice(user_id, subscription_end):
+    """Снимает отметку, если напоминание не удалось отправить, чтобы повторить его при следующей проверке."""
+    await users_collection.update_one(
+        {"user_id": user_id, "renewal_notified_for": subscription_end},
+        {"$unset": {"renewal_notified_for": ""}}
+    )
+    invalidate_user_cache(user_id)
 
 
 async def clear_user_history(user_id):
     result = await history_collection.delete_many({"user_id": user_id})
+    history_buffers.pop(user_id, None)
+    history_counts.pop(user_id, None)
     logger.info(f"🧹 Пользователь {user_id} очистил свою историю запросов.")
     return result.deleted_count
 
 
-async def get_user_info(user_id):
+async def get_user_info(user_id, use_cache=True):
+    if use_cache and user_id in user_cache:
+        return user_cache[user_id]
+
     info = await users_collection.find_one({"user_id": user_id})
+    if info:
+        user_cache[user_id] = info
     return info
 
 
-async def get_current_prompt(user_id):
-    user_data = await get_user_info(user_id)
-    role_key = user_data.get("role", "tarot_reader")
+def get_system_prompt(user_data, model_key):
+    """
+    Системный промпт роли пользователя и его размер в токенах для модели.
+    Для своей роли размер неизвестен заранее — возвращается None.
+    """
     custom_prompt = user_data.get("custom_prompt", "")
+    if user_data.get("role") == CUSTOM_ROLE_KEY and custom_prompt:
+        return build_system_prompt(custom_prompt), None
+
+    role = get_role(user_data.get("role"))
+    return role["system_prompt"], role["system_tokens"].get(model_key)
+
 
-    if role_key == "custom" and custom_prompt:
-        return custom_prompt
-    else:
-        preset = ROLE_PRESETS.get(role_key)
-        return preset["prompt"]
-    
 # Выдача подписки админом
 async def grant_subscription_to_users(user_ids):
     now = datetime.now()
@@ -229,4 +389,6 @@ async def grant_subscription_to_users(user_ids):
             }
         }
     )
+    for user_id in user_ids:
+        invalidate_user_cache(user_id)
     return result.modified_count
\ No newline at end of file
@@ -0,0 +1,145 @@
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from database.client import db
+from database.state import create_state_indexes
+from database.usage_ledger import create_usage_indexes
+from utils.response_cache import create_cache_indexes
+from utils.delayed_actions import create_deletion_indexes
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+migrations_collection = db["migrations"]
+
+
+# Базовые индексы коллекций
+BASE_INDEXES = {
+    "users": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_unique", unique=True),
+        IndexModel([("username", ASCENDING)], name="username"),
+        # Только пользователи с активной подпиской — для проверки окончания подписок
+        IndexModel(
+            [("is_subscribed", ASCENDING), ("subscription_end", ASCENDING)],
+            name="active_subscriptions",
+            partialFilterExpression={"is_subscribed": True}
+        ),
+    ],
+    "history": [
+        IndexModel([("user_id", ASCENDING), ("timestamp", DESCENDING)], name="user_id_timestamp"),
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+    ],
+}
+
+
+async def create_base_indexes():
+    for collection_name, indexes in BASE_INDEXES.items():
+        await db[collection_name].create_indexes(indexes)
+
+
+async def convert_subscription_end_dates():
+    # Диапазонный запрос по дате не находит даты, сохранённые строками
+    await db["users"].update_many(
+        {"is_subscribed": True, "subscription_end": {"$type": "string", "$ne": ""}},
+        [{"$set": {"subscription_end": {
+            "$convert": {"input": "$subscription_end", "to": "date", "onError": None, "onNull": None}
+        }}}]
+    )
+
+
+# Версионированные миграции: (версия, описание, корутина).
+# Новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    (1, "Базовые индексы users и history", create_base_indexes),
+    (2, "TTL-индексы аренд и состояний пользователей", create_state_indexes),
+    (3, "Индексы журнала расхода токенов", create_usage_indexes),
+    (4, "TTL-индекс кэша ответов", create_cache_indexes),
+    (5, "Индекс таймеров удаления сообщений", create_deletion_indexes),
+    (6, "Даты окончания подписки строками -> date", convert_subscription_end_dates),
+]
+
+
+async def run_migrations():
+    """Применяет миграции, которые ещё не отмечены в коллекции migrations."""
+    applied = set()
+    async for doc in migrations_collection.find({}, {"_id": 1}):
+        applied.add(doc["_id"])
+
+    for version, description, migration in MIGRATIONS:
+        if version in applied:
+            continue
+
+        logger.info(f"🛠 Миграция {version}: {description}")
+        try:
+            await migration()
+        except Exception as e:
+            # Например, дубликаты user_id не дают создать уникальный индекс
+            logger.error(f"❌ Миграция {version} не применена: {e}")
+            return False
+
+        try:
+            await migrations_collection.insert_one({
+                "_id": version,
+                "description": description,
+                "applied_at": datetime.now()
+            })
+        except DuplicateKeyError:
+            # Миграцию параллельно применил другой экземпляр бота
+            pass
+
+    return True
+
+
+# Запросы, которые бот выполняет регулярно: (коллекция, описание, фильтр, сортировка)
+QUERY_PATTERNS = [
+    ("users", "поиск пользователя по user_id", {"user_id": 0}, None),
+    ("users", "поиск пользователя по username", {"username": ""}, None),
+    ("users", "подписки, истекающие завтра", {
+        "is_subscribed": True,
+        "subscription_end": {"$gte": datetime(1970, 1, 1), "$lt": datetime(1970, 1, 2)}
+    }, None),
+    ("history", "история пользователя", {"user_id": 0}, [("timestamp", DESCENDING)]),
+    ("history", "страница истории пользователя", {
+        "user_id": 0, "timestamp": {"$lt": datetime(1970, 1, 1)}
+    }, [("timestamp", DESCENDING)]),
+    ("history", "экспорт запросов с даты", {"timestamp": {"$gte": datetime(1970, 1, 1)}}, None),
+]
+
+
+def _collect_plan_stages(plan, stages):
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append((plan["stage"], plan.get("indexName")))
+        for value in plan.values():
+            _collect_plan_stages(value, stages)
+    elif isinstance(plan, list):
+        for item in plan:
+            _collect_plan_stages(item, stages)
+    return stages
+
+
+async def report_index_coverage():
+    """Логирует, какие из регулярных запросов обслуживаются индексом, а какие — полным сканированием."""
+    report = []
+    for collection_name, description, query, sort in QUERY_PATTERNS:
+        cursor = db[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        try:
+            explain = await cursor.explain()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось получить план запроса «{description}»: {e}")
+            continue
+
+        stages = _collect_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}), [])
+        index_names = [index_name for stage, index_name in stages if index_name]
+        covered = any("IXSCAN" in stage for stage, _ in stages) and not any(stage == "COLLSCAN" for stage, _ in stages)
+
+        if covered:
+            logger.info(f"📇 {collection_name}: {description} — индекс {', '.join(index_names)}")
+        else:
+            logger.warning(f"🐢 {collection_name}: {description} — полное сканирование коллекции")
+        report.append((collection_name, description, covered))
+
+    return report
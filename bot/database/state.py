@@ -0,0 +1,115 @@
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+from config import STATE_BACKEND, REQUEST_LEASE_TTL, USER_STATE_TTL
+from database.client import db
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class InMemoryStateBackend:
+    """
+    Аренды и состояния в памяти процесса. Подходит, пока бот запущен в одном экземпляре.
+    """
+
+    def __init__(self):
+        self.leases = {}
+        self.states = {}
+
+    async def acquire_lease(self, key, ttl=REQUEST_LEASE_TTL):
+        now = time.monotonic()
+        lease = self.leases.get(key)
+        if lease is not None and lease[1] > now:
+            return None
+        token = uuid.uuid4().hex
+        self.leases[key] = (token, now + ttl)
+        return token
+
+    async def release_lease(self, key, token):
+        lease = self.leases.get(key)
+        if lease is not None and lease[0] == token:
+            del self.leases[key]
+
+    async def set_state(self, user_id, state, ttl=USER_STATE_TTL):
+        self.states[user_id] = (state, time.monotonic() + ttl)
+
+    async def get_state(self, user_id):
+        entry = self.states.get(user_id)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.states[user_id]
+            return None
+        return entry[0]
+
+    async def clear_state(self, user_id):
+        self.states.pop(user_id, None)
+
+
+class MongoStateBackend:
+    """
+    Аренды и состояния в MongoDB — общие для всех экземпляров бота.
+    Истёкшие документы удаляет TTL-индекс, но проверка срока идёт в самих запросах:
+    TTL-монитор MongoDB срабатывает лишь раз в минуту.
+    """
+
+    def __init__(self, database):
+        self.leases_collection = database["leases"]
+        self.states_collection = database["user_states"]
+
+    async def acquire_lease(self, key, ttl=REQUEST_LEASE_TTL):
+        now = datetime.now(timezone.utc)
+        token = uuid.uuid4().hex
+        try:
+            # Занятую аренду фильтр не найдёт, и upsert упрётся в уникальный _id
+            await self.leases_collection.update_one(
+                {"_id": key, "expires_at": {"$lte": now}},
+                {"$set": {"owner": token, "expires_at": now + timedelta(seconds=ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return None
+        return token
+
+    async def release_lease(self, key, token):
+        await self.leases_collection.delete_one({"_id": key, "owner": token})
+
+    async def set_state(self, user_id, state, ttl=USER_STATE_TTL):
+        await self.states_collection.update_one(
+            {"_id": user_id},
+            {"$set": {"state": state, "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl)}},
+            upsert=True
+        )
+
+    async def get_state(self, user_id):
+        doc = await self.states_collection.find_one(
+            {"_id": user_id, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"state": 1}
+        )
+        return doc["state"] if doc else None
+
+    async def clear_state(self, user_id):
+        await self.states_collection.delete_one({"_id": user_id})
+
+
+STATE_INDEXES = {
+    "leases": [IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0)],
+    "user_states": [IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0)],
+}
+
+
+async def create_state_indexes():
+    for collection_name, indexes in STATE_INDEXES.items():
+        await db[collection_name].create_indexes(indexes)
+
+
+def create_state_backend():
+    if STATE_BACKEND == "mongo":
+        return MongoStateBackend(db)
+    return InMemoryStateBackend()
+
+
+state_backend = create_state_backend()
@@ -0,0 +1,150 @@
+import asyncio
+from datetime import datetime
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
+from config import AI_PRESETS, MONGODB_BOT_URI, MONGODB_DB_NAME, WRITE_BUFFER_INTERVAL, LEDGER_BATCH_SIZE
+from database.client import db, user_write_buffer
+from utils.metrics import PENDING_WRITES
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+usage_collection = db["usage_ledger"]
+
+USAGE_INDEXES = [
+    IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_created_at"),
+    IndexModel([("created_at", ASCENDING)], name="created_at"),
+]
+
+
+async def create_usage_indexes():
+    await usage_collection.create_indexes(USAGE_INDEXES)
+
+
+def calculate_cost(model_key, prompt_tokens, completion_tokens):
+    """Стоимость запроса в долларах по таблице цен AI_PRESETS."""
+    preset = AI_PRESETS.get(model_key, {})
+    cost = (
+        prompt_tokens / 1000 * preset.get("price_per_1000_input_tokens", 0)
+        + completion_tokens / 1000 * preset.get("price_per_1000_output_tokens", 0)
+    )
+    return round(cost, 6)
+
+
+class UsageLedger:
+    """
+    Журнал расхода токенов: одна запись на вызов провайдера.
+    Записи копятся в памяти и вставляются пачкой раз в WRITE_BUFFER_INTERVAL секунд
+    или по достижении LEDGER_BATCH_SIZE записей.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.entries = []
+        self._flush_task = None
+
+    def record(self, user_id, model_key, provider, role, prompt_tokens, completion_tokens, latency, estimated=False):
+        self.entries.append({
+            "user_id": user_id,
+            "model": model_key,
+            "provider": provider,
+            "role": role.get("name"),
+            "max_tokens": role.get("max_tokens"),
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost": calculate_cost(model_key, prompt_tokens, completion_tokens),
+            "latency": round(latency, 3),
+            # Провайдер не сообщил usage — токены посчитаны нашим токенизатором
+            "estimated": estimated,
+            "created_at": datetime.now(),
+        })
+        if len(self.entries) >= LEDGER_BATCH_SIZE and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        if not self.entries:
+            return 0
+        entries, self.entries = self.entries, []
+        try:
+            await self.collection.insert_many(entries, ordered=False)
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать журнал расхода ({len(entries)} записей): {e}")
+            self.entries = entries + self.entries
+            return 0
+        return len(entries)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(WRITE_BUFFER_INTERVAL)
+            await self.flush()
+
+    def flush_sync(self):
+        """Запись остатков журнала без event loop — для atexit."""
+        if not self.entries:
+            return
+        entries, self.entries = self.entries, []
+        client = MongoClient(MONGODB_BOT_URI, serverSelectionTimeoutMS=5000)
+        try:
+            client[MONGODB_DB_NAME][self.collection.name].insert_many(entries, ordered=False)
+        except Exception as e:
+            logger.error(f"❌ Записи журнала расхода потеряны при остановке ({len(entries)}): {e}")
+        finally:
+            client.close()
+
+
+usage_ledger = UsageLedger(usage_collection)
+
+PENDING_WRITES.set_function(lambda: {
+    ("users",): len(user_write_buffer.pending),
+    ("usage_ledger",): len(usage_ledger.entries),
+})
+
+
+async def get_user_usage(user_id, since):
+    """Расход пользователя с даты since по моделям."""
+    cursor = usage_collection.aggregate([
+        {"$match": {"user_id": user_id, "created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": "$model",
+            "requests": {"$sum": 1},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "cost": {"$sum": "$cost"},
+        }},
+        {"$sort": {"cost": -1}},
+    ])
+    return await cursor.to_list(length=None)
+
+
+async def get_daily_usage(since):
+    """Расход всех пользователей с даты since по дням и моделям."""
+    cursor = usage_collection.aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": {
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                "model": "$model",
+            },
+            "requests": {"$sum": 1},
+            "prompt_tokens": {"$sum": "$prompt_tokens"},
+            "completion_tokens": {"$sum": "$completion_tokens"},
+            "cost": {"$sum": "$cost"},
+            "latency": {"$avg": "$latency"},
+        }},
+        {"$sort": {"_id.day": -1, "cost": -1}},
+    ])
+    return await cursor.to_list(length=None)
+
+
+async def get_top_spenders(since, limit=10):
+    """Пользователи с наибольшим расходом с даты since."""
+    cursor = usage_collection.aggregate([
+        {"$match": {"created_at": {"$gte": since}}},
+        {"$group": {
+            "_id": "$user_id",
+            "requests": {"$sum": 1},
+            "cost": {"$sum": "$cost"},
+        }},
+        {"$sort": {"cost": -1}},
+        {"$limit": limit},
+    ])
+    return await cursor.to_list(length=limit)
@@ -0,0 +1,101 @@
+import asyncio
+from pymongo import MongoClient, UpdateOne
+from config import MONGODB_BOT_URI, MONGODB_DB_NAME, WRITE_BUFFER_INTERVAL, WRITE_BUFFER_MAX_USERS
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+class UserWriteBuffer:
+    """
+    Отложенная запись некритичных полей пользователей (last_seen, счётчики статистики).
+    Обновления одного пользователя склеиваются в памяти и раз в WRITE_BUFFER_INTERVAL секунд
+    (или при WRITE_BUFFER_MAX_USERS пользователях в буфере) уходят одним bulk_write.
+    При падении процесса теряется не больше одного интервала таких обновлений,
+    поэтому лимиты запросов через буфер не пишутся.
+    """
+
+    def __init__(self, collection, key_field="user_id"):
+        self.collection = collection
+        self.key_field = key_field
+        self.pending = {}
+        self._flush_task = None
+
+    def _merge(self, key, operator, fields):
+        update = self.pending.setdefault(key, {})
+        target = update.setdefault(operator, {})
+        for field, value in fields.items():
+            if operator == "$inc":
+                target[field] = target.get(field, 0) + value
+            elif operator == "$max" and field in target:
+                target[field] = max(target[field], value)
+            else:
+                target[field] = value
+
+        if len(self.pending) >= WRITE_BUFFER_MAX_USERS:
+            self._schedule_flush()
+
+    def set(self, key, fields):
+        self._merge(key, "$set", fields)
+
+    def inc(self, key, fields):
+        self._merge(key, "$inc", fields)
+
+    def max(self, key, fields):
+        self._merge(key, "$max", fields)
+
+    def _schedule_flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        try:
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+        except RuntimeError:
+            # Нет запущенного цикла — запишем при следующем flush
+            pass
+
+    def _take_pending(self):
+        pending, self.pending = self.pending, {}
+        return pending
+
+    def _restore_pending(self, pending):
+        # Не записалось — возвращаем в буфер, более свежие значения важнее
+        for key, update in pending.items():
+            for operator, fields in update.items():
+                current = self.pending.get(key, {}).get(operator, {})
+                merged = {field: value for field, value in fields.items() if operator != "$set" or field not in current}
+                if merged:
+                    self._merge(key, operator, merged)
+
+    def _build_requests(self, pending):
+        return [UpdateOne({self.key_field: key}, update) for key, update in pending.items()]
+
+    async def flush(self):
+        if not self.pending:
+            return 0
+        pending = self._take_pending()
+        try:
+            await self.collection.bulk_write(self._build_requests(pending), ordered=False)
+        except Exception as e:
+            logger.error(f"❌ Не удалось записать отложенные обновления ({len(pending)} польз.): {e}")
+            self._restore_pending(pending)
+            return 0
+        return len(pending)
+
+    async def run(self):
+        """Фоновая запись буфера раз в WRITE_BUFFER_INTERVAL секунд."""
+        while True:
+            await asyncio.sleep(WRITE_BUFFER_INTERVAL)
+            await self.flush()
+
+    def flush_sync(self):
+        """Запись остатков буфера без event loop — для atexit, когда цикл уже закрыт."""
+        if not self.pending:
+            return
+        pending = self._take_pending()
+        client = MongoClient(MONGODB_BOT_URI, serverSelectionTimeoutMS=5000)
+        try:
+            client[MONGODB_DB_NAME][self.collection.name].bulk_write(self._build_requests(pending), ordered=False)
+            logger.info(f"💾 Отложенные обновления записаны при остановке ({len(pending)} польз.)")
+        except Exception as e:
+            logger.error(f"❌ Отложенные обновления потеряны при остановке ({len(pending)} польз.): {e}")
+        finally:
+            client.close()
@@ -1,17 +1,20 @@
 from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message, CallbackQuery, InputFile
-import pandas as pd
 from io import BytesIO
-import asyncio
-from openpyxl.styles import Alignment
-from openpyxl import load_workbook
+from datetime import datetime, timedelta
 
 
-from database.client import get_all_users, grant_subscription_to_users, users_collection, history_collection
-from config import ADMINS, user_states
+from database.client import grant_subscription_to_users, update_user, users_collection, history_collection
+from config import ADMINS, AI_PRESETS
+from database.state import state_backend
+from database.usage_ledger import get_daily_usage, get_top_spenders
 from utils.logger import get_logger
 from utils.helpers import auto_delete_message
 from utils.keyboards import create_admin_keyboard
+from utils.broadcast import broadcast_engine
+from utils.exports import ExportColumn, stream_export, remove_export_files
+from utils.report_builders import build_table_xlsx
+from utils.report_jobs import report_runner
 
 logger = get_logger(__name__)
 
@@ -24,91 +27,56 @@ async def handle_admin_list_users(bot: AsyncTeleBot, call: CallbackQuery):
         await bot.answer_callback_query(call.id, "⛔ Нет доступа")
         return
 
-    users = await get_all_users()
+    await report_runner.submit(bot, chat_id, "Список пользователей", lambda: send_users_report(bot, chat_id))
 
-    if not users:
+
+def users_report_row(user):
+    user_id_db = int(user["user_id"])
+    username = user.get("username", "Не указан")
+    first_name = user.get("first_name", "Не указан")
+    is_subscribed = "✅" if user.get("is_subscribed", False) else "❌"
+    role = "👑 Админ" if user_id_db in ADMINS else "👤 Пользователь"
+    registered_at = user.get("registered_at", "")
+    if hasattr(registered_at, 'strftime'):
+        registered_at = registered_at.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        registered_at = str(registered_at)
+
+    return (
+        user_id_db,
+        f"@{username}" if username != "Не указан" else "Не указан",
+        first_name,
+        role,
+        is_subscribed,
+        registered_at
+    )
+
+
+async def send_users_report(bot: AsyncTeleBot, chat_id):
+    # Читаем только нужные поля курсором; файл строится в процессе пула отчётов
+    cursor = users_collection.find(
+        {}, {"_id": 0, "user_id": 1, "username": 1, "first_name": 1, "is_subscribed": 1, "registered_at": 1}
+    )
+    rows = [users_report_row(user) async for user in cursor]
+
+    if not rows:
         msg = await bot.send_message(chat_id, "🫥 База данных пуста.")
         await auto_delete_message(bot, chat_id, msg.message_id, delay=5)
         return
 
-    # Подготавливаем данные для Excel
-    data = []
-    for user in users:
-        user_id_db = int(user["user_id"])
-        username = user.get("username", "Не указан")
-        first_name = user.get("first_name", "Не указан")
-        is_subscribed = "✅" if user.get("is_subscribed", False) else "❌"
-        role = "👑 Админ" if user_id_db in ADMINS else "👤 Пользователь"
-        registered_at = user.get("registered_at", "")
-        if hasattr(registered_at, 'strftime'):
-            registered_at = registered_at.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            registered_at = str(registered_at)
-            
-        data.append({
-            "ID пользователя": user_id_db,
-            "Username": f"@{username}" if username != "Не указан" else "Не указан",
-            "Имя": first_name,
-            "Роль": role,
-            "Подписка": is_subscribed,
-            "Дата регистрации": registered_at
-        })
-
     try:
-        # Создаем DataFrame
-        df = pd.DataFrame(data)
-        
-        # Создаём Excel в памяти
-        excel_file = BytesIO()
-        with pd.ExcelWriter(excel_file, engine='openpyxl', mode='w') as writer:
-            df.to_excel(writer, index=False, sheet_name='Пользователи')
-
-        # Редактируем после записи для форматирования
-        excel_file.seek(0)
-        wb = load_workbook(excel_file)
-        ws = wb.active
-
-        # Форматирование: автоширина, перенос текста, выравнивание
-        for col in ws.columns:
-            max_length = 0
-            column = col[0].column_letter
-
-            for cell in col:
-                # Включаем перенос текста и выравнивание
-                if isinstance(cell.value, str) and len(str(cell.value)) > 20:
-                    cell.alignment = Alignment(wrap_text=True, vertical="top")
-                else:
-                    cell.alignment = Alignment(
-                        horizontal="center" if column in ["A", "D", "E"] else "left",
-                        vertical="top"
-                    )
-
-                # Вычисляем максимальную длину для ширины колонки
-                try:
-                    if cell.value:
-                        max_length = max(max_length, len(str(cell.value)))
-                except:
-                    pass
-
-            # Устанавливаем ширину колонки
-            adjusted_width = min(max_length + 2, 30)
-            ws.column_dimensions[column].width = adjusted_width
-
-            # Ограничиваем высоту строк
-            for row in ws.iter_rows():
-                for cell in row:
-                    if isinstance(cell.value, str) and len(cell.value) > 50:
-                        ws.row_dimensions[cell.row].height = min(150, len(cell.value) // 4 * 15)
-
-        # Сохраняем изменения
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
+        content = await report_runner.run_in_process(
+            build_table_xlsx,
+            "Пользователи",
+            ["ID пользователя", "Username", "Имя", "Роль", "Подписка", "Дата регистрации"],
+            rows,
+            centered_columns=(0, 3, 4),
+        )
 
         # Отправляем файл
         await bot.send_document(
             chat_id=chat_id,
-            document=InputFile(output, "Пользователи.xlsx"),
+            document=InputFile(BytesIO(content), "Пользователи.xlsx"),
             caption="📎 Список всех пользователей"
         )
 
@@ -134,7 +102,7 @@ async def handle_admin_grant_subs(bot: AsyncTeleBot, call: CallbackQuery):
 ℹ️ Подписка выдается на месяц
 """
     await bot.send_message(chat_id, text, )
-    user_states[user_id] = "awaiting_user_ids_for_subscription"
+    await state_backend.set_state(user_id, "awaiting_user_ids_for_subscription")
 
 
 async def process_grant_subs_input(bot: AsyncTeleBot, message: Message, input_text: str):
@@ -197,7 +165,7 @@ async def handle_admin_revoke_subs(bot: AsyncTeleBot, call: CallbackQuery):
 ℹ️ Это действие нельзя отменить автоматически
     """
     await bot.send_message(chat_id, text)
-    user_states[user_id] = "awaiting_user_ids_for_revoking"
+    await state_backend.set_state(user_id, "awaiting_user_ids_for_revoking")
 
 
 async def process_revoke_subs_input(bot: AsyncTeleBot, message: Message, input_text: str):
@@ -234,8 +202,8 @@ async def process_revoke_subs_input(bot: AsyncTeleBot, message: Message, input_t
                 continue
 
             # Обновляем подписку
-            result = await users_collection.update_one(
-                {"user_id": user_id},
+            result = await update_user(
+                user_id,
                 {
                     "$set": {
                         "is_subscribed": False,
@@ -262,120 +230,100 @@ async def process_revoke_subs_input(bot: AsyncTeleBot, message: Message, input_t
         failed_msg = f"❌ Не удалось отозвать подписку у следующих пользователей: {', '.join(failed_users)}"
         await bot.send_message(chat_id, failed_msg)
 
+async def handle_admin_usage_report(bot: AsyncTeleBot, call: CallbackQuery):
+    chat_id = call.message.chat.id
+    user_id = call.from_user.id
+
+    if user_id not in ADMINS:
+        await bot.answer_callback_query(call.id, "⛔ Нет доступа")
+        return
+
+    await bot.answer_callback_query(call.id, "Расход токенов")
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    daily = await get_daily_usage(today - timedelta(days=6))
+    top_users = await get_top_spenders(today.replace(day=1))
+
+    if not daily:
+        msg = await bot.send_message(chat_id, "🫥 Журнал расхода пока пуст.")
+        await auto_delete_message(bot, chat_id, msg.message_id, delay=5)
+        return
+
+    text = "💰 <b>Расход за 7 дней</b>\n"
+    current_day = None
+    for row in daily:
+        day, model = row["_id"]["day"], row["_id"]["model"]
+        if day != current_day:
+            current_day = day
+            text += f"\n📅 <b>{day}</b>\n"
+        model_name = AI_PRESETS.get(model, {}).get("name", model)
+        text += (
+            f"▫️ {model_name}: {row['requests']} запр., "
+            f"{row['prompt_tokens']} / {row['completion_tokens']} ток., "
+            f"${row['cost']:.4f}, ~{row['latency']:.1f} с\n"
+        )
+
+    if top_users:
+        text += "\n👤 <b>Топ пользователей за месяц</b>\n"
+        for row in top_users:
+            text += f"▫️ <code>{row['_id']}</code>: {row['requests']} запр., ${row['cost']:.4f}\n"
+
+    await bot.send_message(chat_id, text, parse_mode="HTML")
+
+
 #Вытягивание из бд запросов пользователей
+HISTORY_EXPORT_COLUMNS = [
+    ExportColumn("ID пользователя", 50, centered=True),
+    ExportColumn("Запрос", 50, wrap_after=30),
+    ExportColumn("Ответ", 50, wrap_after=30),
+    ExportColumn("Дата", 50, centered=True),
+]
+
+
+def history_export_row(record):
+    return (record["user_id"], record["query"], record["response"], record["timestamp"].strftime("%Y-%m-%d"))
+
+
 async def export_queries_since_date(bot, chat_id, since_date):
+    """Выгрузка истории запросов с даты: курсор читается пачками, файл пишется в рабочем потоке."""
+    files = []
     try:
-        # Получаем данные из БД
-        cursor = history_collection.find({"timestamp": {"$gte": since_date}})
-        records = await cursor.to_list(length=None)
+        query = {"timestamp": {"$gte": since_date}}
+        total = await history_collection.count_documents(query)
 
-        if not records:
+        if not total:
             msg = await bot.send_message(chat_id, "❌ Нет данных за указанный период.")
             await auto_delete_message(bot, chat_id, msg.message_id, delay=5)
             return
 
-        # Преобразуем данные для DataFrame
-        data = []
-        for record in records:
-            data.append({
-                "ID пользователя": record["user_id"],
-                "Запрос": record["query"],
-                "Ответ": record["response"],
-                "Дата": record["timestamp"].strftime("%Y-%m-%d")
-            })
-
-        df = pd.DataFrame(data)
-
-        # Создаём Excel в памяти
-        excel_file = BytesIO()
-        with pd.ExcelWriter(excel_file, engine='openpyxl', mode='w') as writer:
-            df.to_excel(writer, index=False, sheet_name='Запросы')
-
-        # Редактируем после записи
-        excel_file.seek(0)
-        wb = load_workbook(excel_file)
-        ws = wb.active
-
-        # Настройка: автоширина, перенос текста, выравнивание
-        for col in ws.columns:
-            column = col[0].column_letter
-
-            # Перенос текста и выравнивание
-            for cell in col:
-                wrap_text = isinstance(cell.value, str) and len(str(cell.value)) > 30
-                align_left = cell.column_letter not in ["A", "D"]  # ID и Дата — по центру
-                cell.alignment = Alignment(
-                    wrap_text=wrap_text,
-                    horizontal="center" if column in ["A", "D"] else "left",
-                    vertical="top"
-                )
-
-                # Ограничиваем высоту строки
-                max_row_height = 150
-                ws.row_dimensions[cell.row].height = min(max_row_height, ws.row_dimensions[cell.row].height or 15)
-
-            # Автоширина колонок
-            max_length = 0
-            for cell in col:
-                if cell.value:
-                    max_length = max(max_length, len(str(cell.value)))
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column].width = adjusted_width
+        cursor = history_collection.find(
+            query, {"_id": 0, "user_id": 1, "query": 1, "response": 1, "timestamp": 1}
+        ).sort("timestamp", 1)
+        date_label = since_date.strftime('%Y-%m-%d')
+        files = await stream_export(cursor, history_export_row, HISTORY_EXPORT_COLUMNS, "Запросы", f"Логи от {date_label}", total)
 
-        # Отправляем файл
-        excel_file.seek(0)
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-
-        caption = f"📎 История запросов от {since_date.strftime('%Y-%m-%d')} до текущего дня"
-        await bot.send_document(
-            chat_id=chat_id,
-            document=InputFile(output, f"Логи от {since_date.strftime('%Y-%m-%d')}.xlsx"),
-            caption=caption
-        )
+        caption = f"📎 История запросов от {date_label} до текущего дня"
+        for path, filename in files:
+            # Файл отдаётся с диска, а не целиком из памяти
+            with open(path, "rb") as document:
+                await bot.send_document(chat_id=chat_id, document=InputFile(document, filename), caption=caption)
 
     except Exception as e:
         logger.error(f"❌ Ошибка при экспорте запросов: {e}")
         msg = await bot.send_message(chat_id, "❌ Не удалось сформировать файл")
         await auto_delete_message(bot, chat_id, msg.message_id, delay=5)
+    finally:
+        remove_export_files(files)
 
 #Рассылка о тех. обслуживании
-async def send_maintenance_notification(bot: AsyncTeleBot):
+async def send_maintenance_notification(bot: AsyncTeleBot, chat_id, progress_message_id):
     """
-    Рассылает всем пользователям уведомление о техническом обслуживании.
-    Игнорирует пользователей, которые не писали боту за последние 24 часа.
+    Запускает фоновую рассылку уведомления о техническом обслуживании всем пользователям,
+    кроме заблокировавших бота. Прогресс показывается в сообщении progress_message_id.
     """
-    users = await get_all_users()
-
-    if not users:
-        logger.warning("Нет пользователей для отправки уведомления")
-        return
-
     notification_text = (
         "⚠️ <b>Техническое обслуживание</b>\n\n"
         "Сейчас проводится плановое техническое обслуживание. "
         "Бот будет недоступен в течение некоторого времени.\n\n"
         "Приносим свои извинения за доставленные неудобства."
     )
-
-    failed_sends = []
-
-    for user in users:
-        user_id = user.get("user_id")
-
-        try:
-            await bot.send_message(user_id, notification_text, parse_mode="HTML")
-            await asyncio.sleep(0.05)  # Небольшая пауза, чтобы не спамить Telegram API
-        except Exception as e:
-            logger.error(f"❌ Не удалось отправить сообщение пользователю {user_id}: {e}")
-            failed_sends.append(user_id)
-
-    if failed_sends:
-        logger.info(f"✅ Уведомление отправлено {len(users) - len(failed_sends)} пользователям")
-        logger.warning(f"❌ Не удалось отправить уведомление {len(failed_sends)} пользователям")
-    else:
-        logger.info(f"✅ Уведомление успешно отправлено всем {len(users)} пользователям")
-
-    await bot.send_message(chat_id, "", reply_markup=create_admin_keyboard())
-    return [len(users) - len(failed_sends), len(failed_sends)]
\ No newline at end of file
+    return await broadcast_engine.start(bot, chat_id, progress_message_id, notification_text, parse_mode="HTML")
\ No newline at end of file
@@ -5,15 +5,79 @@ from io import BytesIO
 from telebot.async_telebot import AsyncTeleBot
 from telebot.types import Message
 from utils.helpers import auto_delete_message, clean_ai_response
+from utils.metrics import SPEECH_SECONDS, track
 from utils.logger import get_logger
 
 
 logger = get_logger(__name__)
 
-async def send_to_gpt(model, role, messages, client):
+# Названия провайдеров в сообщениях об ошибках
+AI_ERROR_TITLES = {
+    "gpt-4o": "GPT",
+    "sonar": "Perplexity",
+    "deepseek": "DeepSeek",
+    "dalle3": "DALLE",
+}
+
+
+def describe_ai_error(model_key, error):
+    """Текст ошибки провайдера для пользователя."""
+    title = AI_ERROR_TITLES.get(model_key, model_key)
+
+    if isinstance(error, openai.RateLimitError):
+        return f"⚠️ Превышен лимит обращений к {title}. Попробуйте позже."
+
+    if isinstance(error, openai.BadRequestError) and model_key == "dalle3":
+        if "content_policy_violation" in str(error).lower():
+            return "🥲 Ваш запрос не соответствует политике безопасности OpenAI"
+        return f"⚠️ Не удалось сгенерировать изображение: {str(error)}"
+
+    return f"❌ Не удалось получить ответ от {title}"
+
+
+def fill_usage(usage, reported):
+    """Переносит usage из ответа провайдера в словарь usage вызывающего кода."""
+    if usage is None or reported is None:
+        return
+    usage["prompt_tokens"] = reported.prompt_tokens or 0
+    usage["completion_tokens"] = reported.completion_tokens or 0
+
+
+# Запрос к chat completions. Если передан on_delta — ответ читается потоком,
+# и каждый новый кусок текста передаётся в колбэк.
+# Если передан словарь usage — в него записываются токены запроса и ответа
+async def create_chat_completion(client, on_delta=None, usage=None, stream_usage=True, **kwargs):
+    if on_delta is None:
+        response = await client.chat.completions.create(**kwargs)
+        fill_usage(usage, response.usage)
+        return response.choices[0].message.content
+
+    if usage is not None and stream_usage:
+        # Без этого OpenAI-совместимые API не присылают usage в потоке
+        kwargs["stream_options"] = {"include_usage": True}
+
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    chunks = []
+    async for chunk in stream:
+        fill_usage(usage, getattr(chunk, "usage", None))
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            chunks.append(delta)
+            await on_delta(delta)
+    return "".join(chunks)
+
+
+# Если raise_errors=True, ошибки провайдера пробрасываются наверх (их обрабатывает ProviderRouter),
+# иначе возвращается текст ошибки для пользователя
+async def send_to_gpt(model, role, messages, client, on_delta=None, raise_errors=False, usage=None):
     try: 
         # Вызов gpt
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
+            client,
+            on_delta,
+            usage,
             model=model,
             messages=messages,
             temperature=role["temperature"],
@@ -23,21 +87,25 @@ async def send_to_gpt(model, role, messages, client):
             presence_penalty=role["presence_penalty"]
         )
 
-        response = response.choices[0].message.content.strip()
+        response = response.strip()
 
         return response
 
     except openai.RateLimitError as e:
         logger.error(f"Rate limit error: {str(e)}")
-        return "⚠️ Превышен лимит обращений к GPT. Попробуйте позже."
+        if raise_errors:
+            raise
+        return describe_ai_error("gpt-4o", e)
 
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         logger.warning(e)
-        return "❌ Не удалось получить ответ от GPT"
+        if raise_errors:
+            raise
+        return describe_ai_error("gpt-4o", e)
     
 
-async def send_to_perplexity(model, role, messages, client):
+async def send_to_perplexity(model, role, messages, client, on_delta=None, raise_errors=False, usage=None):
     try:
         kwargs = {
             "model": model,
@@ -52,27 +120,35 @@ async def send_to_perplexity(model, role, messages, client):
         elif role.get("frequency_penalty", 0.0) != 0.0:
             kwargs["frequency_penalty"] = role["frequency_penalty"]
 
-        response = await client.chat.completions.create(**kwargs)
+        # Perplexity сам присылает usage в каждом куске потока, stream_options ему не нужен
+        response = await create_chat_completion(client, on_delta, usage, stream_usage=False, **kwargs)
 
-        response = response.choices[0].message.content.strip()
+        response = response.strip()
         formatted_response = re.sub(r'\[\d\]+', '', response)
 
         return formatted_response
 
     except openai.RateLimitError as e:
         logger.error(f"Rate limit error: {str(e)}")
-        return "⚠️ Превышен лимит обращений к Perplexity. Попробуйте позже."
+        if raise_errors:
+            raise
+        return describe_ai_error("sonar", e)
 
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
         logger.warning(e)
-        return "❌ Не удалось получить ответ от Perplexity"
+        if raise_errors:
+            raise
+        return describe_ai_error("sonar", e)
     
 
-async def send_to_deepseek(model, role, messages, client):
+async def send_to_deepseek(model, role, messages, client, on_delta=None, raise_errors=False, usage=None):
     try: 
         if model == "deepseek": model += "-chat"
-        response = await client.chat.completions.create(
+        response = await create_chat_completion(
+            client,
+            on_delta,
+            usage,
             model=model,
             messages=messages,
             temperature=role["temperature"],
@@ -82,17 +158,21 @@ async def send_to_deepseek(model, role, messages, client):
             presence_penalty=role["presence_penalty"]
         )
 
-        response = response.choices[0].message.content.strip()
+        response = response.strip()
 
         return response
 
     except openai.RateLimitError as e:
         logger.error(f"Rate limit error: {str(e)}")
-        return "⚠️ Превышен лимит обращений к DeepSeek. Попробуйте позже."
+        if raise_errors:
+            raise
+        return describe_ai_error("deepseek", e)
 
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
-        return "❌ Не удалось получить ответ от DeepSeek"
+        if raise_errors:
+            raise
+        return describe_ai_error("deepseek", e)
 
 
 async def send_to_gemini():
@@ -103,7 +183,7 @@ async def send_to_claude():
     pass
 
 
-async def send_to_dalle(model, role, messages, client):
+async def send_to_dalle(model, role, messages, client, raise_errors=False, usage=None):
     try: 
         user_prompt = messages[-1]["content"]
         
@@ -121,18 +201,20 @@ async def send_to_dalle(model, role, messages, client):
 
     except openai.RateLimitError as e:
         logger.error(f"Rate limit error: {str(e)}")
-        return "⚠️ Превышен лимит обращений к DALLE. Попробуйте позже."
+        if raise_errors:
+            raise
+        return describe_ai_error("dalle3", e)
     
     except openai.BadRequestError as e:
-        if "content_policy_violation" in str(e).lower():
-            error_text = "🥲 Ваш запрос не соответствует политике безопасности OpenAI"
-        else:
-            error_text = f"⚠️ Не удалось сгенерировать изображение: {str(e)}"
-        return error_text
+        if raise_errors:
+            raise
+        return describe_ai_error("dalle3", e)
     
     except Exception as e:
         logger.error(f"Ошибка: {str(e)}")
-        return "❌ Не удалось получить ответ от DALLE"
+        if raise_errors:
+            raise
+        return describe_ai_error("dalle3", e)
 
 
 async def send_to_midjourney():
@@ -157,11 +239,12 @@ async def handle_voice_message(bot: AsyncTeleBot, message: Message, client):
         voice_data.name = "audio.ogg"
 
         # Отправляем в OpenAI Whisper
-        transcription = await client.audio.transcriptions.create(
-            model="whisper-1",
-            file=voice_data,
-            response_format="text"
-        )
+        with track(SPEECH_SECONDS, "whisper", kind="whisper"):
+            transcription = await client.audio.transcriptions.create(
+                model="whisper-1",
+                file=voice_data,
+                response_format="text"
+            )
 
         if not transcription or not transcription.strip():
             logger.warning("⚠️ Не удалось распознать речь")
@@ -184,11 +267,12 @@ async def handle_voice_message(bot: AsyncTeleBot, message: Message, client):
 async def handle_text_to_speech(bot: AsyncTeleBot, message: Message, text, client):
     chat_id = message.chat.id
     try:
-        response = await client.audio.speech.create(
-            model="gpt-4o-mini-tts",
-            voice="nova",
-            input=text,
-            instructions = """
+        with track(SPEECH_SECONDS, "tts", kind="tts"):
+            response = await client.audio.speech.create(
+                model="gpt-4o-mini-tts",
+                voice="nova",
+                input=text,
+                instructions = """
 Emotionality/ Individuality: A Cheerful Guide 
 
 Tone: Friendly, clear and encouraging, creating a calm atmosphere and making the listener feel confident and comfortable.
@@ -199,7 +283,7 @@ Pause: Brief, purposeful pauses after key instructions (such as "cross the stree
 
 Emotions: Warm and supportive, conveying empathy and caring, ensuring that the listener feels guided and safe throughout the journey. quickly and clearly.
 """
-        )
+            )
 
         if not response:
             logger.warning("⚠️ Не удалось сгенерировать речь")
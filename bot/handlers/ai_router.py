@@ -0,0 +1,262 @@
+import asyncio
+import time
+import openai
+from collections import deque
+from config import (
+    ROUTER_HEDGING,
+    ROUTER_HEDGE_MIN_DELAY,
+    ROUTER_FAILURE_THRESHOLD,
+    ROUTER_COOLDOWN,
+)
+from handlers.ai_handlers import describe_ai_error
+from database.usage_ledger import usage_ledger
+from utils.request_scheduler import request_scheduler, estimate_request_tokens
+from utils.metrics import PROVIDER_REQUEST_SECONDS, PROVIDER_QUEUE_SECONDS, track
+from utils.tokens import count_tokens, count_message_tokens
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Куда переключаться, если основной провайдер недоступен
+FALLBACK_MODELS = {
+    "gpt-4o": ["deepseek"],
+    "deepseek": ["gpt-4o"],
+    "sonar": ["gpt-4o"],
+}
+
+# Ошибки, которые говорят о проблемах провайдера, а не запроса
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+# Сколько замеров нужно, чтобы доверять p95 при хеджировании
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+
+def is_retryable(error):
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class ProviderStats:
+    """Задержки, ошибки и состояние предохранителя (circuit breaker) одного провайдера."""
+
+    def __init__(self, provider):
+        self.provider = provider
+        # Время до первого ответа: первый кусок потока или весь ответ целиком
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.successes = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def is_available(self, now):
+        # После паузы пропускаем запросы снова: удачный закроет предохранитель, неудачный — откроет
+        return now >= self.open_until
+
+    def p95(self):
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def record_latency(self, latency):
+        self.latencies.append(latency)
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= ROUTER_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + ROUTER_COOLDOWN
+            logger.warning(
+                f"🔌 Провайдер {self.provider} отключён на {ROUTER_COOLDOWN:.0f} с "
+                f"после {self.consecutive_failures} ошибок подряд"
+            )
+
+
+class ProviderRouter:
+    """
+    Прослойка между request_processing и send_to_*: следит за задержками и ошибками
+    провайдеров, не отправляет запросы в отключённого провайдера, переключается на
+    запасного и при необходимости дублирует медленный запрос (hedged request).
+    """
+
+    def __init__(self, ai_handlers):
+        self.ai_handlers = ai_handlers
+        self.stats = {}
+
+    def get_stats(self, model_key):
+        provider = self.ai_handlers[model_key].get("provider", model_key)
+        if provider not in self.stats:
+            self.stats[provider] = ProviderStats(provider)
+        return self.stats[provider]
+
+    def get_candidates(self, model_key, allow_fallback):
+        keys = [model_key]
+        if allow_fallback:
+            keys += FALLBACK_MODELS.get(model_key, [])
+
+        now = time.monotonic()
+        return [
+            key for key in dict.fromkeys(keys)
+            if key in self.ai_handlers and self.get_stats(key).is_available(now)
+        ]
+
+    def get_hedge_delay(self, model_key):
+        p95 = self.get_stats(model_key).p95()
+        if p95 is None:
+            return None
+        return max(ROUTER_HEDGE_MIN_DELAY, p95)
+
+    async def call_provider(self, model_key, role, messages, on_delta=None, user_id=0, is_subscribed=False, on_position=None):
+        handler_info = self.ai_handlers[model_key]
+        provider = handler_info.get("provider", model_key)
+        stats = self.get_stats(model_key)
+        started = None
+        got_output = False
+        received = []
+
+        usage = {}
+        kwargs = {"raise_errors": True, "usage": usage}
+        if on_delta is not None:
+            async def timed_delta(delta):
+                nonlocal got_output
+                if not got_output:
+                    got_output = True
+                    stats.record_latency(time.monotonic() - started)
+                received.append(delta)
+                await on_delta(delta)
+            kwargs["on_delta"] = timed_delta
+
+        # Ждём своей очереди к провайдеру; задержку провайдера меряем уже после неё
+        tokens = estimate_request_tokens(messages, role)
+        queued_at = time.monotonic()
+        async with request_scheduler.slot(provider, user_id, tokens, is_subscribed, on_position):
+            started = time.monotonic()
+            PROVIDER_QUEUE_SECONDS.observe(started - queued_at, provider=provider)
+            try:
+                with track(PROVIDER_REQUEST_SECONDS, "provider", provider=provider, model=model_key):
+                    response = await handler_info["method"](
+                        model_key, role, messages, handler_info["client"], **kwargs
+                    )
+            except asyncio.CancelledError:
+                # Отменённую попытку (проигравший хедж) провайдер уже принял и посчитает — учитываем оценку
+                self.record_usage(
+                    user_id, model_key, provider, role, messages, "".join(received), usage,
+                    time.monotonic() - started
+                )
+                raise
+            except Exception as e:
+                if is_retryable(e):
+                    stats.record_failure()
+                raise
+
+        latency = time.monotonic() - started
+        if not got_output:
+            stats.record_latency(latency)
+        stats.record_success()
+        self.record_usage(user_id, model_key, provider, role, messages, response, usage, latency)
+        return response
+
+    def record_usage(self, user_id, model_key, provider, role, messages, response, usage, latency):
+        estimated = "prompt_tokens" not in usage
+        if estimated:
+            # Провайдер не вернул usage (например, DALL·E) — считаем сами
+            usage["prompt_tokens"] = sum(count_message_tokens(m["content"], model_key) for m in messages)
+            usage["completion_tokens"] = 0 if model_key in ["dalle3", "midjourney"] else count_tokens(response, model_key)
+
+        usage_ledger.record(
+            user_id, model_key, provider, role,
+            usage["prompt_tokens"], usage["completion_tokens"], latency, estimated
+        )
+
+    async def route(self, model_key, role, messages, allow_fallback=False, on_delta=None,
+                    user_id=0, is_subscribed=False, on_position=None):
+        """
+        Выполняет запрос к ИИ с учётом состояния провайдеров и очереди к ним.
+        Возвращает (ok, ответ или текст ошибки, ключ модели, которая ответила).
+        on_position(n) вызывается, пока запрос ждёт в очереди к основному провайдеру.
+        """
+        remaining = self.get_candidates(model_key, allow_fallback)
+        if not remaining:
+            return False, "❌ Данная модель временно недоступна.", model_key
+
+        pending = {}
+        output_owner = None
+        last_error = None
+
+        def start_attempt(key):
+            # При потоковом выводе пишет в сообщение только тот запрос, который ответил первым
+            async def forward_delta(delta):
+                nonlocal output_owner
+                if output_owner is None:
+                    output_owner = key
+                    for task, other_key in pending.items():
+                        if other_key != key:
+                            task.cancel()
+                if output_owner == key:
+                    await on_delta(delta)
+
+            task = asyncio.create_task(
+                self.call_provider(
+                    key, role, messages, forward_delta if on_delta else None,
+                    user_id=user_id,
+                    is_subscribed=is_subscribed,
+                    on_position=on_position if key == model_key else None,
+                )
+            )
+            pending[task] = key
+
+        start_attempt(remaining.pop(0))
+        hedge_delay = self.get_hedge_delay(model_key) if ROUTER_HEDGING and remaining else None
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Основной провайдер отвечает дольше обычного — дублируем запрос запасному
+                    hedge_delay = None
+                    if remaining and output_owner is None:
+                        key = remaining.pop(0)
+                        logger.info(f"🪃 {model_key} отвечает дольше p95, дублируем запрос в {key}", extra={"user_id": user_id, "model": model_key, "fallback_model": key})
+                        start_attempt(key)
+                    continue
+
+                for task in done:
+                    key = pending.pop(task)
+                    if task.cancelled():
+                        continue
+
+                    error = task.exception()
+                    if error is None:
+                        if key != model_key:
+                            logger.info(f"🔀 Запрос к {model_key} обработан моделью {key}", extra={"user_id": user_id, "model": model_key, "fallback_model": key})
+                        return True, task.result(), key
+
+                    last_error = (key, error)
+                    # Ошибка самого запроса или обрыв уже выведенного ответа — не переключаемся
+                    if not is_retryable(error) or output_owner == key:
+                        return False, describe_ai_error(key, error), key
+
+                if not pending and remaining and output_owner is None:
+                    key = remaining.pop(0)
+                    logger.info(f"🔀 Переключаемся с {model_key} на {key}", extra={"user_id": user_id, "model": model_key, "fallback_model": key})
+                    start_attempt(key)
+
+            if last_error is None:
+                return False, "❌ Данная модель временно недоступна.", model_key
+            key, error = last_error
+            return False, describe_ai_error(key, error), key
+
+        finally:
+            for task in pending:
+                task.cancel()
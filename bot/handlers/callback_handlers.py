@@ -1,9 +1,13 @@
 from telebot import types
 from telebot.types import CallbackQuery
+from datetime import datetime
 from config import *
 from database.client import *
+from database.state import state_backend
+from database.usage_ledger import get_user_usage
 from utils.helpers import safe_edit_message, auto_delete_message, extract_russian_text
-from utils.history_pages import show_history_page
+from utils.history_pages import show_history_page, decode_cursor
+from utils.report_jobs import report_runner
 from utils.logger import get_logger
 from handlers.admin_handlers import *
 from utils.keyboards import *
@@ -107,6 +111,15 @@ def register_handlers(bot, ai_handlers):
                     ai_model = AI_PRESETS.get(model, {}).get("name", "ℹ️ Неизвестная модель")
                     response += f"▫️ {ai_model} : <b>{count}</b>\n"
 
+                # Расход токенов по журналу
+                month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+                usage = await get_user_usage(user_id, month_start)
+                if usage:
+                    response += "\n🔢 Токены (запрос / ответ):\n"
+                    for row in usage:
+                        ai_model = AI_PRESETS.get(row["_id"], {}).get("name", "ℹ️ Неизвестная модель")
+                        response += f"▫️ {ai_model} : <b>{row['prompt_tokens']}</b> / <b>{row['completion_tokens']}</b>\n"
+
             await bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=message_id,
@@ -166,8 +179,8 @@ def register_handlers(bot, ai_handlers):
         reply_voice_messages = tts_settings.get("reply_voice_messages", False)
         new_process_voice_messages = not process_voice_messages
             
-        await users_collection.update_one(
-            {"user_id": user_id},
+        await update_user(
+            user_id,
             {
                 "$set": {
                     "tts_settings.process_voice_messages": new_process_voice_messages,
@@ -202,8 +215,8 @@ def register_handlers(bot, ai_handlers):
         reply_voice_messages = tts_settings.get("reply_voice_messages", False)
         new_reply_voice_messages = not reply_voice_messages
             
-        await users_collection.update_one(
-            {"user_id": user_id},
+        await update_user(
+            user_id,
             {
                 "$set": {
                     "tts_settings.process_voice_messages": process_voice_messages,
@@ -229,14 +242,9 @@ def register_handlers(bot, ai_handlers):
     async def handle_choose_ai(call: CallbackQuery):
         chat_id = call.message.chat.id
         user_id = call.from_user.id
-        await ensure_user_exists(call.from_user)
-        user_data = await get_user_info(user_id)
+        user_data = await ensure_user_exists(call.from_user)
 
-        if not user_data:
-            await ensure_user_exists(call.from_user)
-            user_data = await users_collection.find_one({"user_id": user_id})
-
-        markup = await create_ai_keyboard(user_id, ai_handlers)
+        markup = await create_ai_keyboard(user_id, ai_handlers, user_data)
         await bot.edit_message_text(
             chat_id=chat_id,
             message_id=call.message.message_id,
@@ -270,7 +278,7 @@ def register_handlers(bot, ai_handlers):
                 await bot.answer_callback_query(call.id, "✅ Модель уже выбрана")
                 return
 
-            await users_collection.update_one({"user_id": user_id}, {"$set": {"ai_model": model_key}})
+            await update_user(user_id, {"$set": {"ai_model": model_key}})
             description = model_data["description"]
             name = model_data["name"]
 
@@ -327,7 +335,7 @@ def register_handlers(bot, ai_handlers):
                 await auto_delete_message(bot, chat_id, msg.message_id)
                 return
             else:
-                await users_collection.update_one({"user_id": user_id}, {"$set": {"role": role_key}})
+                await update_user(user_id, {"$set": {"role": role_key}})
                 description = role_data["description"]
                 name = role_data["name"]
                 text = f"""
@@ -347,10 +355,12 @@ def register_handlers(bot, ai_handlers):
 
     @bot.callback_query_handler(func=lambda call: call.data.startswith("history_"))
     async def handle_history_navigation(call: CallbackQuery):
+        # history_<направление>_<номер текущей страницы>_<курсор>
         try:
             data_parts = call.data.split("_")
             direction = data_parts[1]
             page_index = int(data_parts[2])
+            cursor = decode_cursor(data_parts[3]) if len(data_parts) > 3 else None
         except (ValueError, IndexError):
             await bot.answer_callback_query(call.id, "Неверные данные")
             return
@@ -367,10 +377,14 @@ def register_handlers(bot, ai_handlers):
             await bot.answer_callback_query(call.id, "Неизвестная команда")
             return
 
-        # Удаляем старое сообщение и показываем новую страницу
-        await bot.delete_message(chat_id, message_id)
-        await show_history_page(bot, chat_id, user_id, new_index)
-        await bot.answer_callback_query(call.id)
+        # Редактируем это же сообщение; кнопки без курсора (старого формата) открывают первую страницу
+        shown = await show_history_page(
+            bot, chat_id, user_id, new_index, direction=direction, cursor=cursor, message_id=message_id
+        )
+        if shown:
+            await bot.answer_callback_query(call.id)
+        else:
+            await bot.answer_callback_query(call.id, "⛔ Это конец истории.")
 
 
     @bot.callback_query_handler(func=lambda call: call.data == "clear_history")
@@ -445,6 +459,24 @@ def register_handlers(bot, ai_handlers):
     async def handle_list_users(call:CallbackQuery):
         await handle_admin_list_users(bot, call)
 
+    # Отмена отчёта, ожидающего в очереди или формируемого
+    @bot.callback_query_handler(func=lambda call: call.data.startswith("cancel_report:"))
+    async def handle_cancel_report(call: CallbackQuery):
+        if call.from_user.id not in ADMINS:
+            await bot.answer_callback_query(call.id, "⛔ Доступ запрещён")
+            return
+
+        job_id = int(call.data.split(":", 1)[1])
+        if await report_runner.cancel(job_id):
+            await bot.answer_callback_query(call.id, "Отчёт отменён")
+        else:
+            await bot.answer_callback_query(call.id, "Отчёт уже сформирован")
+
+    # Расход токенов и стоимость запросов
+    @bot.callback_query_handler(func=lambda call: call.data == "admin_usage_report")
+    async def handle_usage_report(call: CallbackQuery):
+        await handle_admin_usage_report(bot, call)
+
     # Колбэк для перехода к выдаче подписки
     @bot.callback_query_handler(func=lambda call:call.data == "admin_grant_subs")
     async def handle_grant_subs(call:CallbackQuery):
@@ -488,17 +520,20 @@ def register_handlers(bot, ai_handlers):
     async def handle_confirm_maintenance_send(call: CallbackQuery):
         chat_id = call.message.chat.id
 
+        if call.from_user.id not in ADMINS:
+            await bot.answer_callback_query(call.id, "⛔ Доступ запрещён")
+            return
+
         msg =await bot.edit_message_text(
             chat_id=chat_id,
             message_id=call.message.message_id,
             text="⏳ Рассылка уведомлений...",
             reply_markup=None
         )
+        await bot.answer_callback_query(call.id)
 
-        response = await send_maintenance_notification(bot)
-
-        await auto_delete_message(bot, chat_id, msg.message_id, delay=3)
-        await bot.send_message(chat_id, f"🔔 Все пользователи ({response[0]}) уведомлены о техническом обслуживании.\n⚠️ {response[1]} не были уведомлены.")
+        # Рассылка идёт в фоне, это сообщение показывает её прогресс
+        await send_maintenance_notification(bot, chat_id, msg.message_id)
 
 
     @bot.callback_query_handler(func=lambda call: call.data == "cancel_maintenance_send")
@@ -520,4 +555,4 @@ def register_handlers(bot, ai_handlers):
 
         # Запрашиваем дату у пользователя
         await bot.send_message(chat_id, "📅 Введите дату в формате ГГГГ-ММ-ДД, от которой экспортировать запросы:")
-        user_states[user_id] = "awaiting_export_date"
\ No newline at end of file
+        await state_backend.set_state(user_id, "awaiting_export_date")
\ No newline at end of file
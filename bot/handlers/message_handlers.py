@@ -1,23 +1,33 @@
+import asyncio
 from telebot import types
 from telebot.types import Message, LabeledPrice
 from datetime import datetime, timedelta
 from config import *
 from database.client import *
+from database.state import state_backend
 from utils.keyboards import *
 from utils.helpers import *
 from utils.history_pages import show_history_page
-from utils.limits_check import check_ai_usage
+from utils.limits_check import check_ai_usage, reserve_ai_request, refund_ai_request
 from utils.logger import get_logger
-from utils.subscription_checker import check_subscriptions_expiry
 from utils.image_helpers import download_url_image
+from utils.stream_editor import StreamingMessageEditor
+from utils.timing import StageTimer
+from utils.report_jobs import report_runner
+from utils.metrics import ACTIVE_REQUESTS, count_error, record_stages
 
 from handlers.admin_handlers import process_grant_subs_input, process_revoke_subs_input, export_queries_since_date
 from handlers.ai_handlers import handle_voice_message, handle_text_to_speech
+from handlers.ai_router import ProviderRouter
+from presets.registry import get_model, get_role
+from utils.response_cache import response_cache, get_cache_ttl, make_cache_key
 from utils.keyboards import create_admin_keyboard
 
 logger = get_logger(__name__)
 
-def register_handlers(bot, user_tasks, ai_handlers):
+def register_handlers(bot, ai_handlers):
+    provider_router = ProviderRouter(ai_handlers)
+
     @bot.message_handler(commands=["start"])
     async def cmd_send_welcome(message: Message): 
         await ensure_user_exists(message.from_user)
@@ -69,11 +79,9 @@ def register_handlers(bot, user_tasks, ai_handlers):
     async def cmd_choose_ai(message: Message):
         user = message.from_user
         user_id = user.id
-        await ensure_user_exists(user)
-        
-        user_data = await get_user_info(user_id)
-        
-        markup = await create_ai_keyboard(user_id, ai_handlers)
+        user_data = await ensure_user_exists(user)
+
+        markup = await create_ai_keyboard(user_id, ai_handlers, user_data)
         await bot.send_message(message.chat.id, AI_MENU_MESSAGE, reply_markup=markup)
 
 
@@ -81,11 +89,9 @@ def register_handlers(bot, user_tasks, ai_handlers):
     async def cmd_choose_role(message: Message):
         user = message.from_user
         user_id = user.id
-        await ensure_user_exists(user)
-
-        user_data = await get_user_info(user_id)
+        user_data = await ensure_user_exists(user)
 
-        markup = await create_role_keyboard(user_id)
+        markup = await create_role_keyboard(user_id, user_data)
         await bot.send_message(message.chat.id, ROLE_MENU_MESSAGE, reply_markup=markup, parse_mode="Markdown")
 
 
@@ -118,10 +124,7 @@ def register_handlers(bot, user_tasks, ai_handlers):
         ensure_user_exists(user)
         user_id = user.id
 
-        users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"role": "custom"}}
-        )
+        await update_user(user_id, {"$set": {"role": "custom"}})
 
         await bot.send_message(message.chat.id, """
     ✏️ Введите свой системный промпт.
@@ -130,7 +133,7 @@ def register_handlers(bot, user_tasks, ai_handlers):
 
     Ваш промпт:
     """)
-        user_states[user_id] = "waiting_for_custom_prompt"
+        await state_backend.set_state(user_id, "waiting_for_custom_prompt")
 
 
     @bot.message_handler(commands=["subscribe"])
@@ -149,8 +152,8 @@ def register_handlers(bot, user_tasks, ai_handlers):
             return
 
         if user_id in ADMINS:
-            users_collection.update_one(
-                {"user_id": user_id},
+            await update_user(
+                user_id,
                 {"$set": {"is_subscribed": True, "subscription_end": None}}  # Без ограничения по времени
             )
             msg = await bot.send_message(chat_id, "👑 Вы — админ. Подписка активна навсегда.")
@@ -187,8 +190,8 @@ def register_handlers(bot, user_tasks, ai_handlers):
         payment_info = message.successful_payment
         logger.info(f"💰 Пользователь {user_id} оплатил подписку: {payment_info.total_amount} {payment_info.currency}")
 
-        await users_collection.update_one(
-            {"user_id": user_id},
+        await update_user(
+            user_id,
             {
                 "$set": {
                     "is_subscribed": True,
@@ -206,10 +209,7 @@ def register_handlers(bot, user_tasks, ai_handlers):
         user_id = user.id
         await ensure_user_exists(user)
         
-        await users_collection.update_one(
-            {"user_id": user_id},
-            {"$set": {"is_subscribed": False}}
-        )
+        await update_user(user_id, {"$set": {"is_subscribed": False}})
         await bot.send_message(message.chat.id, "❌ Вы отписались от бота.")
 
 
@@ -217,15 +217,11 @@ def register_handlers(bot, user_tasks, ai_handlers):
     async def cmd_send_history(message: Message):
         user_id = message.from_user.id
         chat_id = message.chat.id
-        history = await get_user_history(user_id)
         await ensure_user_exists(message.from_user)
 
-        if not history:
+        if not await show_history_page(bot, chat_id, user_id, page_index=0):
             msg = await bot.send_message(message.chat.id, "История запросов пуста.")
             await auto_delete_message(bot, message.chat.id, msg.message_id)
-            return
-        
-        await show_history_page(bot, chat_id, user_id, page_index=0)
 
 
     @bot.message_handler(commands=["privacy"])
@@ -252,22 +248,30 @@ def register_handlers(bot, user_tasks, ai_handlers):
         )
 
 
+    # Фильтр: админ, от которого ждём ввода в состоянии state
+    def admin_state_filter(state):
+        async def check(message: Message):
+            if message.from_user.id not in ADMINS:
+                return False
+            return await state_backend.get_state(message.from_user.id) == state
+        return check
+
     # Принимаем ввод пользователей от админа
-    @bot.message_handler(func=lambda m: m.from_user.id in ADMINS and user_states.get(m.from_user.id) == "awaiting_user_ids_for_subscription")
+    @bot.message_handler(func=admin_state_filter("awaiting_user_ids_for_subscription"))
     async def handle_grant_subscription_input(message: Message):
         user_id = message.from_user.id
         input_text = message.text.strip()
         await process_grant_subs_input(bot, message, input_text)
-        user_states.pop(user_id, None)
+        await state_backend.clear_state(user_id)
     
-    @bot.message_handler(func=lambda m: m.from_user.id in ADMINS and user_states.get(m.from_user.id) == "awaiting_user_ids_for_revoking")
+    @bot.message_handler(func=admin_state_filter("awaiting_user_ids_for_revoking"))
     async def handle_revoke_subscription_input(message: Message):
         user_id = message.from_user.id
         input_text = message.text.strip()
         await process_revoke_subs_input(bot, message, input_text)
-        user_states.pop(user_id, None)
+        await state_backend.clear_state(user_id)
 
-    @bot.message_handler(func=lambda m: m.from_user.id in ADMINS and user_states.get(m.from_user.id) == "awaiting_export_date")
+    @bot.message_handler(func=admin_state_filter("awaiting_export_date"))
     async def process_export_date(message):
         user_id = message.from_user.id
         chat_id = message.chat.id
@@ -280,10 +284,13 @@ def register_handlers(bot, user_tasks, ai_handlers):
             await bot.delete_message(chat_id, message.message_id)
 
             # Сбрасываем состояние
-            user_states.pop(user_id, None)
+            await state_backend.clear_state(user_id)
 
-            # Экспортируем данные
-            await export_queries_since_date(bot, chat_id, since_date)
+            # Экспортируем данные через очередь отчётов, чтобы долгая выгрузка не держала обработчик
+            await report_runner.submit(
+                bot, chat_id, f"История запросов с {since_date.strftime('%Y-%m-%d')}",
+                lambda: export_queries_since_date(bot, chat_id, since_date)
+            )
 
         except ValueError:
             msg = await bot.send_message(chat_id, "❌ Неверный формат даты. Используйте ГГГГ-ММ-ДД")
@@ -309,7 +316,8 @@ def register_handlers(bot, user_tasks, ai_handlers):
                     await auto_delete_message(bot, chat_id, msg.message_id)
                     return
             
-            allowed, reason = await check_ai_usage(user_id, user_data["ai_model"])
+            # Только проверяем лимит: списание будет при отправке распознанного текста в ИИ
+            allowed, reason = await check_ai_usage(user_id, user_data["ai_model"], user_data)
             if not allowed:
                 msg = await bot.send_message(chat_id, reason + ".\n\nС подпиской ограничения на использование ИИ исчезнут")
                 await auto_delete_message(bot, chat_id, msg.message_id, 3)
@@ -328,7 +336,7 @@ def register_handlers(bot, user_tasks, ai_handlers):
             
             if process_voice_messages:
             #Основная логика обработки пользовательского запроса
-                await request_processing(bot, message,ai_handlers, user_id, chat_id, voice_message_text, error_markup, processing_msg)
+                await request_processing(bot, message,ai_handlers, user_id, chat_id, voice_message_text, error_markup, processing_msg, user_data)
         
         except Exception as e:
             if processing_msg:
@@ -350,20 +358,21 @@ def register_handlers(bot, user_tasks, ai_handlers):
         user_prompt = message.text
         error_markup = create_inline_menu(SUPPORT_BUTTON)
         processing_msg = None
-        await ensure_user_exists(user)
+        user_data = await ensure_user_exists(user)
 
         #Основная логика обработки пользовательского запроса
-        await request_processing(bot, message, ai_handlers, user_id, chat_id, user_prompt, error_markup, processing_msg)
+        await request_processing(bot, message, ai_handlers, user_id, chat_id, user_prompt, error_markup, processing_msg, user_data)
     
 
-    async def request_processing(bot, message, ai_handlers, user_id, chat_id, user_prompt, error_markup, processing_msg):
+    # user_data — документ пользователя, полученный в начале обработки апдейта.
+    # Передаётся дальше по цепочке, чтобы не перечитывать его из бд на каждом шаге
+    async def request_processing(bot, message, ai_handlers, user_id, chat_id, user_prompt, error_markup, processing_msg, user_data=None):
+        lease_token = None
+        ai_model = None
+        quota_reserved = False
+        history_task = None
+        timer = StageTimer()
         try:
-            def get_key_by_name(name):
-                for key, data in AI_PRESETS.items():
-                    if data.get("name") == name:
-                        return key
-                return None  # Если не найдено
-
             if user_prompt.strip().startswith("/"):
                 # Игнор команд, которые не обрабатываются отдельно
                 logger.warning(f"Пользователь {user_id} отправил команду, но она не поддерживается: {user_prompt}")
@@ -371,19 +380,22 @@ def register_handlers(bot, user_tasks, ai_handlers):
                 await auto_delete_message(bot, chat_id, msg.message_id, 3)
                 return
             
-            await check_subscriptions_expiry(bot, user_id=user_id)
+            if user_data is None:
+                user_data = await timer.measure("user", get_user_info(user_id))
 
-            # Проверка, есть ли уже активный запрос у пользователя
-            if user_id in user_tasks:
+            # Один активный запрос на пользователя — аренда общая для всех экземпляров бота
+            lease_token = await timer.measure("lease", state_backend.acquire_lease(user_id))
+            if lease_token is None:
                 msg = await bot.send_message(chat_id, "⏳ Пожалуйста, дождитесь ответа на предыдущее сообщение")
                 await auto_delete_message(bot, chat_id, msg.message_id, 2)
                 return
+            ACTIVE_REQUESTS.inc()
             
-            user_data = await get_user_info(user_id)
-            ai_preset = AI_PRESETS.get(user_data["ai_model"], AI_PRESETS["gpt-4o"])
-            ai_role = ROLE_PRESETS.get(user_data["role"], ROLE_PRESETS["tarot_reader"])
-            ai_model = get_key_by_name(ai_preset["name"])
-            role_prompt = await get_current_prompt(user_id)
+            # Модель, роль и системный промпт берём из реестра, собранного при запуске
+            ai_preset = get_model(user_data["ai_model"])
+            ai_role = get_role(user_data["role"])
+            ai_model = ai_preset["key"]
+            system_prompt, system_tokens = get_system_prompt(user_data, ai_model)
 
             tts_settings = user_data.get("tts_settings", {})
             reply_voice_messages = tts_settings.get("reply_voice_messages", False)
@@ -394,19 +406,14 @@ def register_handlers(bot, user_tasks, ai_handlers):
                 msg = await bot.send_message(chat_id, "❌ Данная модель временно недоступна.")
                 await auto_delete_message(bot, chat_id, msg.message_id, 2)
                 return
-            
-            ai_method = handler_info["method"]
-            ai_client = handler_info["client"]
 
-            # Проверяем подписку и лимиты
-            allowed, reason = await check_ai_usage(user_id, user_data["ai_model"])
+            # Резервируем запрос в пределах лимита; вернём его, если ИИ не ответит
+            allowed, reason = await timer.measure("quota", reserve_ai_request(user_id, ai_model))
             if not allowed:
                 msg = await bot.send_message(chat_id, reason + ".\n\nС подпиской ограничения на использование ИИ исчезнут")
                 await auto_delete_message(bot, chat_id, msg.message_id, 3)
                 return
-            
-            # Формирование messages с историей прошлых запросов
-            messages = await build_history_messages(user_id, role_prompt, user_prompt, max_history=10)
+            quota_reserved = True
             
             processing_msg_text = ""
             # Временное сообщение об обработке
@@ -414,29 +421,81 @@ def register_handlers(bot, user_tasks, ai_handlers):
                 processing_msg_text = f"🧠 {ai_preset['name']} генерирует изображение по вашему описанию\n\nℹ️ Созданные изображения не сохраняются в истории"
             else:
                 processing_msg_text = f"🧠 {ai_preset['name']} формулирует ответ как {ai_role["name"]}"
-            
-            processing_msg = await bot.reply_to(message, processing_msg_text)
 
-            # Добавление в очередь задач
-            user_tasks[user_id] = True
-
-            # Вызов ИИ
-            ai_response = await ai_method(
-                ai_model, ai_role,
-                messages, ai_client
-                
+            # Временное сообщение и сборка messages с историей прошлых запросов друг от друга не зависят
+            processing_msg, messages = await asyncio.gather(
+                timer.measure("placeholder", bot.reply_to(message, processing_msg_text)),
+                timer.measure("history", build_history_messages(
+                    user_id, system_prompt, user_prompt, max_history=10, model_key=ai_model, system_tokens=system_tokens
+                ))
             )
 
+            # Потоковый вывод: ответ появляется прямо во временном сообщении
+            stream_editor = None
+            if STREAM_RESPONSES and handler_info.get("stream") and not reply_voice_messages:
+                stream_editor = StreamingMessageEditor(bot, chat_id, processing_msg.message_id)
+
+            # Пока запрос ждёт в очереди к провайдеру, показываем место в ней
+            queue_msg_id = processing_msg.message_id
+            async def show_queue_position(position):
+                await safe_edit_message(bot, chat_id, queue_msg_id, f"{processing_msg_text}\n\n⏳ Место в очереди: {position}")
+
+            # Вызов ИИ. Без подписки модель не выбирается, поэтому при сбоях можно ответить запасной
+            is_subscribed = user_data.get("is_subscribed", False)
+            allow_fallback = not is_subscribed or ROUTER_FALLBACK_FOR_SUBSCRIBERS
+            # Повторный запрос к роли с кэшем отдаём без обращения к провайдеру
+            cache_ttl = get_cache_ttl(ai_role) if ai_model not in ["dalle3", "midjourney"] else 0
+            cache_key = make_cache_key(ai_model, messages) if cache_ttl else None
+            cached_response = await timer.measure("cache", response_cache.get(cache_key)) if cache_key else None
+
+            if cached_response is not None:
+                ok, ai_response = True, cached_response
+                logger.info(f"♻️ Ответ {ai_model} для пользователя {user_id} взят из кэша", extra={"user_id": user_id, "model": ai_model})
+            else:
+                ok, ai_response, used_model = await timer.measure("provider", provider_router.route(
+                    ai_model, ai_role, messages,
+                    allow_fallback=allow_fallback,
+                    on_delta=stream_editor.push if stream_editor else None,
+                    user_id=user_id,
+                    is_subscribed=is_subscribed,
+                    on_position=show_queue_position
+                ))
+                # Ответ запасной модели не кэшируем под ключом выбранной
+                if ok and cache_key and used_model == ai_model:
+                    run_in_background(response_cache.set(cache_key, ai_response, cache_ttl), "response_cache_set")
+
+            if not ok:
+                # Ошибку провайдера показываем вместо ответа, но не сохраняем в историю
+                if stream_editor and await stream_editor.finish(ai_response, parse_mode=None):
+                    processing_msg = None
+                else:
+                    await auto_delete_message(bot, chat_id, processing_msg.message_id, 0)
+                    processing_msg = None
+                    await bot.send_message(chat_id, ai_response)
+                return
+
+            # Ответ получен — запрос списан окончательно
+            quota_reserved = False
+
             if ai_response != None and ai_model not in ["dalle3", "midjourney"]:
                 formatted_response = clean_ai_response(ai_response)
                 # formatted_response = ai_response
-                await save_query_to_history(user_id, user_prompt, formatted_response)
-                
-                # Удаление временного сообщения
-                await auto_delete_message(bot, chat_id, processing_msg.message_id, 5)
+                # История пишется параллельно с доставкой ответа; дожидаемся её до снятия аренды,
+                # чтобы следующий запрос пользователя уже видел этот ответ в контексте
+                history_task = run_in_background(save_query_to_history(user_id, user_prompt, formatted_response), "history_save")
+
+                if not stream_editor:
+                    # Удаление временного сообщения
+                    await auto_delete_message(bot, chat_id, processing_msg.message_id, 5)
 
                 # Отправка реального сообщения
-                if reply_voice_messages:
+                if stream_editor:
+                    # Временное сообщение уже стало ответом; если дописать его не вышло — отправляем отдельно
+                    if not await stream_editor.finish(formatted_response):
+                        await auto_delete_message(bot, chat_id, processing_msg.message_id, 0)
+                        await bot.send_message(chat_id, formatted_response, parse_mode="HTML")
+                    processing_msg = None
+                elif reply_voice_messages:
                     processing_msg_text = "🎤 Записываю ответ"
                     processing_msg = await bot.reply_to(message, processing_msg_text)
                     audio_response = await handle_text_to_speech (bot, message, formatted_response, ai_handlers["gpt-4o"]["client"])
@@ -451,12 +510,6 @@ def register_handlers(bot, user_tasks, ai_handlers):
                 else:
                     await bot.send_message(chat_id, formatted_response, parse_mode="HTML")
 
-                #Счетчик исп-я +1
-                await users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$inc": {f"monthly_usage.{ai_model}": 1}}  # Увеличиваем счётчик
-                )
-
             elif ai_response != None and ai_model in ["dalle3", "midjourney"]:
                 image = await download_url_image(chat_id, ai_response)
                 caption=f"🖼️Изображение по вашему запросу:\n<code>{messages[-1]["content"]}</code>"
@@ -472,14 +525,9 @@ def register_handlers(bot, user_tasks, ai_handlers):
 
                 # Удаление временного сообщения
                 await auto_delete_message(bot, chat_id, processing_msg.message_id, 0 )
-
-                #Счетчик исп-я +1
-                await users_collection.update_one(
-                    {"user_id": user_id},
-                    {"$inc": {f"monthly_usage.{ai_model}": 1}}  # Увеличиваем счётчик
-                )
         except Exception as e:
             logger.error(f"Ошибка при обработке запроса: {e}")
+            count_error("request", e)
             if processing_msg:
                 await auto_delete_message(bot, chat_id, processing_msg.message_id, 0)
 
@@ -491,6 +539,19 @@ def register_handlers(bot, user_tasks, ai_handlers):
             await auto_delete_message(bot, chat_id, msg.message_id, 30)
 
         finally:
-            # Удаляем из списка активных задач
-            if user_id in user_tasks:
-                del user_tasks[user_id]
\ No newline at end of file
+            if history_task is not None:
+                with timer.stage("history_save_wait"):
+                    await asyncio.wait([history_task])
+            if quota_reserved:
+                await refund_ai_request(user_id, ai_model)
+            # Освобождаем аренду, только если брали её мы
+            if lease_token is not None:
+                await state_backend.release_lease(user_id, lease_token)
+                ACTIVE_REQUESTS.dec()
+                record_stages(timer)
+                logger.info(f"⏱️ Запрос пользователя {user_id}: {timer.format()}", extra={
+                    "user_id": user_id,
+                    "model": ai_model,
+                    "latency": round(timer.total(), 3),
+                    "stages": {stage: round(duration, 3) for stage, duration in timer.stages.items()},
+                })
\ No newline at end of file
@@ -5,6 +5,7 @@ AI_PRESETS = {
         "style": "нейтральный",
         "price_per_1000_input_tokens": 0.005,
         "price_per_1000_output_tokens": 0.015,
+        "context_tokens": 6000,
     },
     "yandex_gpt": {
         "name": "Yandex GPT",
@@ -12,6 +13,7 @@ AI_PRESETS = {
         "style": "формальный",
         "price_per_1000_input_tokens": 0.0015,
         "price_per_1000_output_tokens": 0.002,
+        "context_tokens": 4000,
     },
     "gigachat": {
         "name": "GigaChat",
@@ -19,6 +21,7 @@ AI_PRESETS = {
         "style": "творческий",
         "price_per_1000_input_tokens": 0.001,
         "price_per_1000_output_tokens": 0.0015,
+        "context_tokens": 4000,
     },
     "sonar": {
         "name": "Perplexity",
@@ -26,6 +29,7 @@ AI_PRESETS = {
         "style": "аналитический",
         "price_per_1000_input_tokens": 0.001,
         "price_per_1000_output_tokens": 0.001,
+        "context_tokens": 4000,
     },
     "deepseek": {
         "name": "DeepSeek",
@@ -33,6 +37,7 @@ AI_PRESETS = {
         "style": "аналитический",
         "price_per_1000_input_tokens": 0.0007,
         "price_per_1000_output_tokens": 0.0007,
+        "context_tokens": 6000,
     },
     "claude": {
         "name": "Claude 3.7",
@@ -40,6 +45,7 @@ AI_PRESETS = {
         "style": "аналитический",
         "price_per_1000_input_tokens": 0.003,
         "price_per_1000_output_tokens": 0.015,
+        "context_tokens": 6000,
     },
     "dalle3": {
         "name": "DALL·E 3",
@@ -47,6 +53,7 @@ AI_PRESETS = {
         "style": "вдохновляющий",
         "price_per_1000_input_tokens": 0.02,
         "price_per_1000_output_tokens": 0.02,
+        "context_tokens": 1000,
     },
     "midjourney": {
         "name": "Midjourney",
@@ -54,5 +61,6 @@ AI_PRESETS = {
         "style": "вдохновляющий",
         "price_per_1000_input_tokens": 0.02,
         "price_per_1000_output_tokens": 0.02,
+        "context_tokens": 1000,
     }
 }
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""
+Реестр ролей и моделей, который собирается один раз при запуске.
+Пресеты проверяются здесь же, поэтому ошибка в них останавливает бота при старте,
+а не посреди запроса пользователя. Записи реестра неизменяемые.
+"""
+from types import MappingProxyType
+from config import AI_PRESETS, ROLE_PRESETS, GENERAL_SYSTEM_PROMPT
+from utils.tokens import count_message_tokens
+
+DEFAULT_MODEL_KEY = "gpt-4o"
+DEFAULT_ROLE_KEY = "tarot_reader"
+CUSTOM_ROLE_KEY = "custom"
+
+# Допустимые диапазоны параметров генерации
+SAMPLING_RANGES = {
+    "temperature": (0.0, 2.0),
+    "top_p": (0.0, 1.0),
+    "frequency_penalty": (-2.0, 2.0),
+    "presence_penalty": (-2.0, 2.0),
+}
+
+
+def build_system_prompt(role_prompt):
+    return f"{role_prompt}\n{GENERAL_SYSTEM_PROMPT}"
+
+
+def validate_role(key, preset):
+    for field in ("name", "prompt"):
+        if not isinstance(preset.get(field), str):
+            raise ValueError(f"Роль {key}: поле {field} должно быть строкой")
+    if not preset["prompt"] and key != CUSTOM_ROLE_KEY:
+        raise ValueError(f"Роль {key}: пустой prompt")
+
+    for field, (low, high) in SAMPLING_RANGES.items():
+        value = preset.get(field)
+        if not isinstance(value, (int, float)) or not low <= value <= high:
+            raise ValueError(f"Роль {key}: {field}={value!r} вне диапазона [{low}, {high}]")
+
+    max_tokens = preset.get("max_tokens")
+    if not isinstance(max_tokens, int) or max_tokens <= 0:
+        raise ValueError(f"Роль {key}: max_tokens={max_tokens!r} должен быть положительным целым")
+
+    cache_ttl = preset.get("cache_ttl", 0)
+    if not isinstance(cache_ttl, int) or cache_ttl < 0:
+        raise ValueError(f"Роль {key}: cache_ttl={cache_ttl!r} должен быть неотрицательным целым")
+
+
+def validate_model(key, preset):
+    if not isinstance(preset.get("name"), str):
+        raise ValueError(f"Модель {key}: поле name должно быть строкой")
+    for field in ("price_per_1000_input_tokens", "price_per_1000_output_tokens"):
+        value = preset.get(field)
+        if not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"Модель {key}: {field}={value!r} должен быть неотрицательным числом")
+    context_tokens = preset.get("context_tokens")
+    if not isinstance(context_tokens, int) or context_tokens <= 0:
+        raise ValueError(f"Модель {key}: context_tokens={context_tokens!r} должен быть положительным целым")
+
+
+def build_role_registry():
+    registry = {}
+    for key, preset in ROLE_PRESETS.items():
+        validate_role(key, preset)
+        system_prompt = build_system_prompt(preset["prompt"])
+        registry[key] = MappingProxyType({
+            **preset,
+            "key": key,
+            "system_prompt": system_prompt,
+            # Размер системного сообщения для бюджета контекста каждой модели
+            "system_tokens": MappingProxyType({
+                model_key: count_message_tokens(system_prompt, model_key) for model_key in AI_PRESETS
+            }),
+        })
+    if DEFAULT_ROLE_KEY not in registry:
+        raise ValueError(f"В ROLE_PRESETS нет роли по умолчанию {DEFAULT_ROLE_KEY}")
+    return MappingProxyType(registry)
+
+
+def build_model_registry():
+    registry = {}
+    for key, preset in AI_PRESETS.items():
+        validate_model(key, preset)
+        registry[key] = MappingProxyType({**preset, "key": key})
+    if DEFAULT_MODEL_KEY not in registry:
+        raise ValueError(f"В AI_PRESETS нет модели по умолчанию {DEFAULT_MODEL_KEY}")
+    return MappingProxyType(registry)
+
+
+def build_name_index(registry):
+    index = {}
+    for key, entry in registry.items():
+        if entry["name"] in index:
+            raise ValueError(f"Название {entry['name']!r} используется у {index[entry['name']]} и {key}")
+        index[entry["name"]] = key
+    return MappingProxyType(index)
+
+
+ROLE_REGISTRY = build_role_registry()
+MODEL_REGISTRY = build_model_registry()
+MODEL_KEYS_BY_NAME = build_name_index(MODEL_REGISTRY)
+
+
+def get_role(role_key):
+    return ROLE_REGISTRY.get(role_key) or ROLE_REGISTRY[DEFAULT_ROLE_KEY]
+
+
+def get_model(model_key):
+    return MODEL_REGISTRY.get(model_key) or MODEL_REGISTRY[DEFAULT_MODEL_KEY]
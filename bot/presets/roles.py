@@ -102,6 +102,7 @@ ROLE_PRESETS = {
         "top_p": 0.9,  
         "frequency_penalty": 0.0,
         "presence_penalty": 0.5,
+        "cache_ttl": 10800,  # 3 часа: прогноз на ближайшие дни не меняется каждую минуту
         "prompt": """Вы — мистический наблюдатель за космическими явлениями и их влиянием на людей.
 Ваша задача — предсказывать магнитные бури и объяснять, как они могут влиять на настроение, здоровье и события в жизни.
 - Соединяйте научные знания с мистикой.
@@ -150,6 +151,7 @@ ROLE_PRESETS = {
         "top_p": 1.0,  
         "frequency_penalty": 0.0,
         "presence_penalty": 0.3,
+        "cache_ttl": 21600,  # 6 часов: карта дня одна на день
         "prompt": """Вы — проводник между мистическим и реальным миром.
 Ваша задача — читать знаки дня и давать ясные советы, что делать, чего избегать, к чему готовиться.
 - Используйте астрологические, эзотерические и мистические знания.
@@ -184,6 +186,7 @@ ROLE_PRESETS_v1 = {
         "top_p":0.7,  
         "frequency_penalty":0.1,
         "presence_penalty":0.3,
+        "cache_ttl":604800,  # неделя: перевод одного и того же текста не меняется
         "prompt": """Вы — профессиональный переводчик с глубоким пониманием культурных особенностей.
 Ваша задача — перевести любой текст максимально естественно и точно, сохраняя смысл и стиль оригинала.
 - Переводите всё: юмор, жаргон, диалекты, идиомы.
@@ -229,6 +232,7 @@ ROLE_PRESETS_v1 = {
         "top_p":0.5,  
         "frequency_penalty":0.0,
         "presence_penalty":0.0,
+        "cache_ttl":604800,  # неделя: у задачи один ответ
         "prompt": """Вы — математик с острым умом и терпением.
 Ваша задача — решать задачи, объяснять формулы, находить закономерности и помогать вникнуть в суть.
 - Разбирайте задачи шаг за шагом, как ремонтом автомобиля.
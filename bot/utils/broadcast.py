@@ -0,0 +1,288 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from telebot.apihelper import ApiTelegramException
+from config import (
+    BROADCAST_RATE,
+    BROADCAST_CONCURRENCY,
+    BROADCAST_CHUNK_SIZE,
+    BROADCAST_PROGRESS_INTERVAL,
+    BROADCAST_MAX_RETRIES,
+    BROADCAST_HEARTBEAT_INTERVAL,
+    BROADCAST_OWNER_TTL,
+)
+from database.client import db, users_collection, invalidate_user_cache
+from utils.helpers import safe_edit_message
+from utils.rate_limit import TokenBucket
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+broadcasts_collection = db["broadcasts"]
+
+# Ошибки, после которых писать пользователю бессмысленно
+BLOCKED_ERRORS = ("bot was blocked by the user", "user is deactivated", "bot can't initiate conversation")
+
+
+class BroadcastOwnershipLost(Exception):
+    """Рассылку забрал другой экземпляр бота — этот экземпляр больше её не отправляет."""
+
+
+def is_blocked_error(error):
+    return error.error_code == 403 or any(text in str(error).lower() for text in BLOCKED_ERRORS)
+
+
+def get_retry_after(error):
+    parameters = (error.result_json or {}).get("parameters") or {}
+    return parameters.get("retry_after", 1)
+
+
+def format_progress(doc):
+    status = {
+        "running": "⏳ Рассылка идёт",
+        "done": "✅ Рассылка завершена",
+        "failed": "❌ Рассылка прервана",
+    }.get(doc["status"], doc["status"])
+    return (
+        f"{status}\n\n"
+        f"📨 Доставлено: {doc['sent']} из ~{doc['total']}\n"
+        f"⛔ Заблокировали бота: {doc['blocked']}\n"
+        f"⚠️ Не доставлено: {doc['failed']}"
+    )
+
+
+class Broadcast:
+    """
+    Одна рассылка. Пользователи читаются курсором по возрастанию user_id пачками по BROADCAST_CHUNK_SIZE,
+    пачка отправляется BROADCAST_CONCURRENCY параллельными отправками, после каждой пачки
+    прогресс сохраняется в коллекцию broadcasts. После перезапуска рассылка продолжается
+    с последней сохранённой пачки: повторно могут уйти только сообщения незавершённой пачки.
+    Прогресс записывается только пока документ принадлежит этому экземпляру (поле owner).
+    """
+
+    def __init__(self, bot, doc, bucket):
+        self.bot = bot
+        self.doc = doc
+        self.bucket = bucket
+        self.semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        # Общая пауза после 429: Telegram ограничивает бота целиком, а не отдельный чат
+        self.paused_until = 0.0
+        self.blocked_ids = []
+        self.reported_at = 0.0
+
+    async def wait_turn(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.bucket.try_consume():
+                return
+            await asyncio.sleep(self.bucket.time_until())
+
+    async def send_one(self, user_id):
+        async with self.semaphore:
+            for attempt in range(BROADCAST_MAX_RETRIES + 1):
+                await self.wait_turn()
+                try:
+                    await self.bot.send_message(user_id, self.doc["text"], parse_mode=self.doc.get("parse_mode"))
+                    self.doc["sent"] += 1
+                    return
+                except ApiTelegramException as e:
+                    if e.error_code == 429 and attempt < BROADCAST_MAX_RETRIES:
+                        retry_after = get_retry_after(e)
+                        logger.warning(f"🐢 Рассылка: Telegram просит подождать {retry_after} с")
+                        self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                        continue
+                    if is_blocked_error(e):
+                        self.blocked_ids.append(user_id)
+                        self.doc["blocked"] += 1
+                        return
+                    logger.warning(f"⚠️ Рассылка: не удалось отправить сообщение {user_id}: {e}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Рассылка: не удалось отправить сообщение {user_id}: {e}")
+                self.doc["failed"] += 1
+                return
+
+    async def save_progress(self, last_user_id):
+        self.doc["last_user_id"] = last_user_id
+        if self.blocked_ids:
+            blocked_ids, self.blocked_ids = self.blocked_ids, []
+            await users_collection.update_many({"user_id": {"$in": blocked_ids}}, {"$set": {"is_blocked": True}})
+            for user_id in blocked_ids:
+                invalidate_user_cache(user_id)
+        result = await broadcasts_collection.update_one({"_id": self.doc["_id"], "owner": self.doc["owner"]}, {"$set": {
+            "last_user_id": last_user_id,
+            "sent": self.doc["sent"],
+            "failed": self.doc["failed"],
+            "blocked": self.doc["blocked"],
+            "updated_at": datetime.now(),
+            "heartbeat_at": datetime.now(),
+        }})
+        if result.matched_count == 0:
+            raise BroadcastOwnershipLost()
+
+    async def report_progress(self, force=False):
+        if not force and time.monotonic() - self.reported_at < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self.reported_at = time.monotonic()
+        await safe_edit_message(
+            self.bot, self.doc["admin_chat_id"], self.doc["progress_message_id"], format_progress(self.doc)
+        )
+
+    async def run(self):
+        cursor = users_collection.find(
+            {"user_id": {"$gt": self.doc["last_user_id"]}, "is_blocked": {"$ne": True}},
+            {"_id": 0, "user_id": 1},
+            batch_size=BROADCAST_CHUNK_SIZE
+        ).sort("user_id", 1)
+
+        chunk = []
+        async for user in cursor:
+            chunk.append(user["user_id"])
+            if len(chunk) >= BROADCAST_CHUNK_SIZE:
+                await self.send_chunk(chunk)
+                chunk = []
+        if chunk:
+            await self.send_chunk(chunk)
+
+    async def send_chunk(self, user_ids):
+        await asyncio.gather(*(self.send_one(user_id) for user_id in user_ids))
+        await self.save_progress(user_ids[-1])
+        await self.report_progress()
+
+
+class BroadcastEngine:
+    """
+    Запускает рассылки в фоне. Один token bucket на все рассылки — лимит Telegram общий для бота.
+    Рассылку ведёт один экземпляр бота: он записан в документе как owner и раз в
+    BROADCAST_HEARTBEAT_INTERVAL обновляет heartbeat_at. Другой экземпляр может забрать
+    рассылку, только если владельца нет или его отметка старше BROADCAST_OWNER_TTL.
+    """
+
+    def __init__(self):
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.tasks = {}
+        self.owner = uuid.uuid4().hex
+
+    async def start(self, bot, admin_chat_id, progress_message_id, text, parse_mode=None):
+        doc = {
+            "text": text,
+            "parse_mode": parse_mode,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "status": "running",
+            "owner": self.owner,
+            "heartbeat_at": datetime.now(),
+            "last_user_id": 0,
+            "total": await users_collection.count_documents({"is_blocked": {"$ne": True}}),
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+        }
+        result = await broadcasts_collection.insert_one(doc)
+        doc["_id"] = result.inserted_id
+        logger.info(f"📣 Рассылка {doc['_id']} запущена, получателей ~{doc['total']}")
+        self._launch(bot, doc)
+        return doc["_id"]
+
+    def _launch(self, bot, doc):
+        task = asyncio.create_task(self._run(Broadcast(bot, doc, self.bucket)))
+        self.tasks[doc["_id"]] = task
+        task.add_done_callback(lambda _: self.tasks.pop(doc["_id"], None))
+
+    async def _heartbeat(self, doc):
+        while True:
+            await asyncio.sleep(BROADCAST_HEARTBEAT_INTERVAL)
+            try:
+                result = await broadcasts_collection.update_one(
+                    {"_id": doc["_id"], "owner": self.owner},
+                    {"$set": {"heartbeat_at": datetime.now()}}
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Рассылка {doc['_id']}: не удалось обновить отметку владельца: {e}")
+                continue
+            if result.matched_count == 0:
+                # Рассылку забрали; отправка остановится при следующем сохранении прогресса
+                return
+
+    async def _run(self, broadcast):
+        doc = broadcast.doc
+        heartbeat = asyncio.create_task(self._heartbeat(doc))
+        try:
+            await broadcast.run()
+            doc["status"] = "done"
+        except asyncio.CancelledError:
+            # Остановка бота: рассылка останется running и продолжится после запуска
+            raise
+        except BroadcastOwnershipLost:
+            logger.warning(f"⚠️ Рассылку {doc['_id']} продолжает другой экземпляр бота")
+            return
+        except Exception as e:
+            logger.error(f"❌ Рассылка {doc['_id']} прервана: {e}")
+            doc["status"] = "failed"
+        finally:
+            heartbeat.cancel()
+
+        result = await broadcasts_collection.update_one({"_id": doc["_id"], "owner": self.owner}, {"$set": {
+            "status": doc["status"],
+            "sent": doc["sent"],
+            "failed": doc["failed"],
+            "blocked": doc["blocked"],
+            "finished_at": datetime.now(),
+        }})
+        if result.matched_count == 0:
+            logger.warning(f"⚠️ Рассылку {doc['_id']} продолжает другой экземпляр бота")
+            return
+        await broadcast.report_progress(force=True)
+        logger.info(
+            f"📣 Рассылка {doc['_id']}: доставлено {doc['sent']}, "
+            f"заблокировали {doc['blocked']}, не доставлено {doc['failed']}"
+        )
+
+    async def claim_next(self):
+        """Атомарно забирает одну прерванную рассылку без живого владельца, иначе None."""
+        now = datetime.now()
+        return await broadcasts_collection.find_one_and_update(
+            {
+                "status": "running",
+                "_id": {"$nin": list(self.tasks)},
+                "$or": [
+                    {"owner": None},
+                    {"heartbeat_at": {"$lt": now - timedelta(seconds=BROADCAST_OWNER_TTL)}},
+                ],
+            },
+            {"$set": {"owner": self.owner, "heartbeat_at": now}},
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def resume(self, bot):
+        """Продолжает рассылки, прерванные остановкой бота, — только те, что удалось забрать себе."""
+        while True:
+            doc = await self.claim_next()
+            if doc is None:
+                return
+            logger.info(f"📣 Продолжаем рассылку {doc['_id']}: уже доставлено {doc['sent']}")
+            self._launch(bot, doc)
+
+    async def stop(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Отпускаем свои рассылки, чтобы следующий запуск забрал их сразу, не дожидаясь BROADCAST_OWNER_TTL
+        try:
+            await broadcasts_collection.update_many(
+                {"status": "running", "owner": self.owner},
+                {"$set": {"owner": None}}
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось освободить рассылки при остановке: {e}")
+
+
+broadcast_engine = BroadcastEngine()
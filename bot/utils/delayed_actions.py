@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from config import DELAYED_DELETE_PERSIST_AFTER
+from database.client import db
+from utils.logger import get_logger
+from utils.metrics import DELAYED_DELETIONS
+
+logger = get_logger(__name__)
+
+deletions_collection = db["delayed_deletions"]
+
+DELETION_INDEXES = [IndexModel([("due_at", ASCENDING)], name="due_at")]
+
+# Telegram разрешает боту удалять сообщения не старше 48 часов
+TELEGRAM_DELETE_WINDOW = timedelta(hours=48)
+# Не больше стольких сообщений в одном deleteMessages
+DELETE_BATCH_SIZE = 100
+
+
+async def create_deletion_indexes():
+    await deletions_collection.create_indexes(DELETION_INDEXES)
+
+
+class DelayedDeleter:
+    """
+    Отложенное удаление сообщений без блокировки обработчиков.
+    Таймеры лежат в куче по времени срабатывания, их обслуживает одна фоновая задача.
+    Сработавшие одновременно удаления в одном чате уходят одним deleteMessages.
+    Долгие таймеры (от DELAYED_DELETE_PERSIST_AFTER секунд) и всё, что не успело сработать
+    к остановке, сохраняются в бд и восстанавливаются при следующем запуске.
+    Запись в бд идёт в фоне: таймер попадает в кучу сразу, и schedule не ждёт бд.
+    """
+
+    def __init__(self):
+        self.bot = None
+        # (время срабатывания по loop.time(), порядковый номер, chat_id, message_id, _id в бд или None)
+        self.heap = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._task = None
+        # Фоновые записи таймеров в бд и _id таймеров, которые записать не удалось
+        self._save_tasks = set()
+        self._unsaved = set()
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    def _push(self, due, chat_id, message_id, doc_id=None):
+        heapq.heappush(self.heap, (due, next(self._counter), chat_id, message_id, doc_id))
+        self._ensure_running()
+        self._wakeup.set()
+
+    async def schedule(self, bot, chat_id, message_id, delay):
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+
+        doc_id = None
+        if delay >= DELAYED_DELETE_PERSIST_AFTER:
+            # _id задаём сами, чтобы таймер в куче ссылался на документ ещё до записи
+            doc_id = ObjectId()
+            task = asyncio.create_task(self._save(doc_id, chat_id, message_id, delay))
+            self._save_tasks.add(task)
+            task.add_done_callback(self._save_tasks.discard)
+
+        self._push(loop.time() + delay, chat_id, message_id, doc_id)
+
+    async def _save(self, doc_id, chat_id, message_id, delay):
+        try:
+            await deletions_collection.insert_one({
+                "_id": doc_id,
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "due_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+            })
+        except Exception as e:
+            # Таймер остаётся в памяти; при остановке попробуем сохранить его ещё раз
+            self._unsaved.add(doc_id)
+            logger.warning(f"⚠️ Не удалось сохранить таймер удаления сообщения {message_id}: {e}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            if not self.heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = self.heap[0][0] - loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due = []
+            now = loop.time()
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap))
+            await self._execute(due)
+
+    async def _execute(self, due):
+        by_chat = defaultdict(list)
+        for _, _, chat_id, message_id, _ in due:
+            by_chat[chat_id].append(message_id)
+
+        await asyncio.gather(*(
+            self._delete_in_chat(chat_id, message_ids) for chat_id, message_ids in by_chat.items()
+        ))
+
+        doc_ids = [doc_id for *_, doc_id in due if doc_id is not None and doc_id not in self._unsaved]
+        self._unsaved.difference_update(doc_id for *_, doc_id in due)
+        if doc_ids:
+            try:
+                await deletions_collection.delete_many({"_id": {"$in": doc_ids}})
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось снять выполненные таймеры удаления: {e}")
+
+    async def _delete_in_chat(self, chat_id, message_ids):
+        try:
+            if len(message_ids) == 1:
+                await self.bot.delete_message(chat_id, message_ids[0])
+                return
+            for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                await self.bot.delete_messages(chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить сообщения {message_ids} в чате {chat_id}: {e}")
+
+    async def restore(self, bot):
+        """Поднимает таймеры, сохранённые в бд до перезапуска."""
+        self.bot = bot
+        loop = asyncio.get_running_loop()
+        now = datetime.now(timezone.utc)
+        stale_ids = []
+        restored = 0
+
+        async for doc in deletions_collection.find({}):
+            due_at = doc["due_at"].replace(tzinfo=timezone.utc)
+            if now - due_at > TELEGRAM_DELETE_WINDOW:
+                stale_ids.append(doc["_id"])
+                continue
+            delay = max(0.0, (due_at - now).total_seconds())
+            self._push(loop.time() + delay, doc["chat_id"], doc["message_id"], doc["_id"])
+            restored += 1
+
+        if stale_ids:
+            await deletions_collection.delete_many({"_id": {"$in": stale_ids}})
+        if restored:
+            logger.info(f"⏲️ Восстановлено таймеров удаления сообщений: {restored}")
+
+    async def stop(self):
+        """Останавливает таймеры; несохранённые записывает в бд, чтобы доделать после запуска."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Дожидаемся фоновых записей, чтобы знать, какие таймеры уже лежат в бд
+        await asyncio.gather(*self._save_tasks, return_exceptions=True)
+
+        loop = asyncio.get_running_loop()
+        now = datetime.now(timezone.utc)
+        pending = [
+            {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "due_at": now + timedelta(seconds=max(0.0, due - loop.time())),
+            }
+            for due, _, chat_id, message_id, doc_id in self.heap if doc_id is None or doc_id in self._unsaved
+        ]
+        self.heap = []
+        self._unsaved.clear()
+        if pending:
+            try:
+                await deletions_collection.insert_many(pending, ordered=False)
+                logger.info(f"⏲️ Таймеры удаления сохранены до следующего запуска: {len(pending)}")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить таймеры удаления ({len(pending)}): {e}")
+
+
+delayed_deleter = DelayedDeleter()
+
+DELAYED_DELETIONS.set_function(lambda: len(delayed_deleter.heap))
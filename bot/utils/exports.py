@@ -0,0 +1,161 @@
+"""
+Потоковая выгрузка больших таблиц.
+Записи читаются курсором пачками, а запись пачки в файл идёт в рабочем потоке,
+поэтому event loop не блокируется, а в памяти одновременно лежит только одна пачка.
+До EXPORT_XLSX_MAX_ROWS строк пишется xlsx (openpyxl в режиме write-only),
+больше — CSV в gzip, разбитый на части не больше EXPORT_PART_MAX_BYTES.
+"""
+import asyncio
+import csv
+import gzip
+import io
+import os
+import tempfile
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+from config import EXPORT_BATCH_SIZE, EXPORT_XLSX_MAX_ROWS, EXPORT_PART_MAX_BYTES
+
+
+class ExportColumn:
+    def __init__(self, title, max_width, centered=False, wrap_after=None):
+        self.title = title
+        self.max_width = max_width
+        self.centered = centered
+        # Перенос текста для значений длиннее wrap_after символов
+        self.wrap_after = wrap_after
+
+
+def compute_column_widths(columns, rows):
+    """Ширина колонок за один проход по строкам: по самому длинному значению, но не больше max_width."""
+    lengths = [len(column.title) for column in columns]
+    for row in rows:
+        for i, value in enumerate(row):
+            if value is not None:
+                lengths[i] = max(lengths[i], len(str(value)))
+    return [min(length + 2, column.max_width) for length, column in zip(lengths, columns)]
+
+
+class XlsxExportWriter:
+    """
+    Пишет строки в xlsx в режиме write-only: openpyxl сразу сбрасывает их во временный файл.
+    Ширина колонок задаётся до первой строки, поэтому считается по первой пачке.
+    """
+
+    def __init__(self, columns, sheet_name, filename):
+        self.columns = columns
+        self.filename = filename
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(sheet_name)
+        self.started = False
+        # Один объект стиля на вариант, а не на каждую ячейку
+        self.alignments = {
+            (centered, wrap): Alignment(horizontal="center" if centered else "left", vertical="top", wrap_text=wrap)
+            for centered in (False, True) for wrap in (False, True)
+        }
+
+    def _start(self, first_rows):
+        for i, width in enumerate(compute_column_widths(self.columns, first_rows), start=1):
+            self.sheet.column_dimensions[get_column_letter(i)].width = width
+        self.sheet.append([self._cell(column.title, column) for column in self.columns])
+        self.started = True
+
+    def _cell(self, value, column):
+        cell = WriteOnlyCell(self.sheet, value=value)
+        wrap = column.wrap_after is not None and isinstance(value, str) and len(value) > column.wrap_after
+        cell.alignment = self.alignments[(column.centered, wrap)]
+        return cell
+
+    def write_rows(self, rows):
+        if not self.started:
+            self._start(rows)
+        for row in rows:
+            self.sheet.append([self._cell(value, column) for value, column in zip(row, self.columns)])
+
+    def finish(self):
+        if not self.started:
+            self._start([])
+        file = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+        file.close()
+        self.workbook.save(file.name)
+        return [(file.name, self.filename)]
+
+
+class CsvExportWriter:
+    """CSV в gzip; новая часть начинается, когда сжатый файл дорастает до EXPORT_PART_MAX_BYTES."""
+
+    def __init__(self, columns, filename):
+        self.columns = columns
+        self.filename = filename
+        self.parts = []
+        self.raw = None
+        self.gzip = None
+        self.text = None
+        self.writer = None
+
+    def _open_part(self):
+        self.raw = tempfile.NamedTemporaryFile(suffix=".csv.gz", delete=False)
+        self.gzip = gzip.GzipFile(fileobj=self.raw, mode="wb")
+        # utf-8-sig — чтобы Excel правильно открыл кириллицу
+        self.text = io.TextIOWrapper(self.gzip, encoding="utf-8-sig", newline="")
+        self.writer = csv.writer(self.text)
+        self.writer.writerow([column.title for column in self.columns])
+        self.parts.append(self.raw.name)
+
+    def _close_part(self):
+        self.text.close()
+        self.raw.close()
+        self.text = None
+
+    def write_rows(self, rows):
+        if self.text is None:
+            self._open_part()
+        self.writer.writerows(rows)
+        self.text.flush()
+        if self.raw.tell() >= EXPORT_PART_MAX_BYTES:
+            self._close_part()
+
+    def finish(self):
+        if self.text is None and not self.parts:
+            self._open_part()
+        if self.text is not None:
+            self._close_part()
+        if len(self.parts) == 1:
+            return [(self.parts[0], f"{self.filename}.csv.gz")]
+        return [(path, f"{self.filename} (часть {i}).csv.gz") for i, path in enumerate(self.parts, start=1)]
+
+
+async def stream_export(cursor, to_row, columns, sheet_name, filename, total):
+    """
+    Выгружает курсор в файлы и возвращает список (путь к временному файлу, имя для отправки).
+    Временные файлы удаляет вызывающий код — см. remove_export_files.
+    """
+    if total <= EXPORT_XLSX_MAX_ROWS:
+        writer = XlsxExportWriter(columns, sheet_name, f"{filename}.xlsx")
+    else:
+        writer = CsvExportWriter(columns, filename)
+
+    try:
+        batch = []
+        async for document in cursor.batch_size(EXPORT_BATCH_SIZE):
+            batch.append(to_row(document))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                await asyncio.to_thread(writer.write_rows, batch)
+                batch = []
+        if batch:
+            await asyncio.to_thread(writer.write_rows, batch)
+
+        return await asyncio.to_thread(writer.finish)
+    except BaseException:
+        # Уже записанные части CSV не должны остаться на диске
+        remove_export_files([(path, None) for path in getattr(writer, "parts", [])])
+        raise
+
+
+def remove_export_files(files):
+    for path, _ in files:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -2,32 +2,101 @@ import asyncio
 import re
 import telebot
 from datetime import datetime
-from config import GENERAL_SYSTEM_PROMPT
-from database.client import get_user_history
+from config import AI_PRESETS
+from database.client import get_history_window
+from utils.delayed_actions import delayed_deleter
 from utils.logger import get_logger
+from utils.metrics import BACKGROUND_TASKS
+from utils.tokens import count_tokens, count_message_tokens, TOKENS_PER_MESSAGE
 
 logger = get_logger(__name__)
 
-async def build_history_messages(user_id, role_prompt, user_prompt, max_history=10):
-    user_history = await get_user_history(user_id)
-    history = user_history[-max_history:]
+DEFAULT_CONTEXT_TOKENS = 4000
 
-    role_prompt += f"\n{GENERAL_SYSTEM_PROMPT}"
 
-    messages = [{"role": "system", "content": role_prompt}]
-    for entry in history:
+def history_entry_tokens(entry):
+    # У старых записей нет сохранённого размера — считаем один раз и запоминаем в буфере
+    if entry.get("query_tokens") is None:
+        entry["query_tokens"] = count_tokens(entry["query"])
+    if entry.get("response_tokens") is None:
+        entry["response_tokens"] = count_tokens(entry["response"])
+    return entry["query_tokens"] + entry["response_tokens"] + 2 * TOKENS_PER_MESSAGE
+
+
+async def build_history_messages(user_id, system_prompt, user_prompt, max_history=10, model_key=None, system_tokens=None):
+    """
+    Собирает messages: системный промпт, последние реплики из истории и новый запрос.
+    Реплики добавляются от новых к старым, пока укладываются в бюджет токенов модели.
+    system_tokens — заранее посчитанный размер системного промпта (см. presets.registry).
+    """
+    history = await get_history_window(user_id, max_history)
+    budget = AI_PRESETS.get(model_key, {}).get("context_tokens", DEFAULT_CONTEXT_TOKENS)
+
+    if system_tokens is None:
+        system_tokens = count_message_tokens(system_prompt, model_key)
+    used_tokens = system_tokens + count_message_tokens(user_prompt, model_key)
+
+    turns = []
+    for entry in reversed(history):
+        entry_tokens = history_entry_tokens(entry)
+        if used_tokens + entry_tokens > budget:
+            break
+        turns.append(entry)
+        used_tokens += entry_tokens
+    turns.reverse()
+
+    if len(turns) < len(history):
+        logger.info(
+            f"✂️ Контекст пользователя {user_id} урезан: {len(turns)} из {len(history)} реплик, "
+            f"~{used_tokens} токенов при бюджете {budget}"
+        )
+
+    messages = [{"role": "system", "content": system_prompt}]
+    for entry in turns:
         messages.append({"role": "user", "content": entry["query"]})
         messages.append({"role": "assistant", "content": entry["response"]})
     messages.append({"role": "user", "content": user_prompt})
     return messages
 
 
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора до завершения
+background_tasks = set()
+BACKGROUND_TASKS.set_function(lambda: len(background_tasks))
+
+
+def _on_background_task_done(task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"❌ Ошибка в фоновой задаче {task.get_name()}: {task.exception()}")
+
+
+def run_in_background(coro, name=None):
+    """Запускает корутину вне пути ответа пользователю; ошибки только логируются."""
+    task = asyncio.create_task(coro, name=name)
+    background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+async def wait_background_tasks(timeout=10):
+    """Дожидается фоновых задач при остановке бота."""
+    if not background_tasks:
+        return
+    _, pending = await asyncio.wait(set(background_tasks), timeout=timeout)
+    if pending:
+        logger.warning(f"⚠️ Не дождались фоновых задач при остановке: {len(pending)}")
+
+
 async def auto_delete_message(bot, chat_id, message_id, delay=5):
-    try:
-        await asyncio.sleep(delay)  # Ждём указанное количество секунд
-        await bot.delete_message(chat_id, message_id)
-    except Exception as e:
-        logger.warning(f"⚠️ Не удалось удалить сообщение {message_id}: {e}")
+    # Без задержки удаляем сразу, чтобы сообщение исчезло раньше следующего ответа
+    if delay <= 0:
+        try:
+            await bot.delete_message(chat_id, message_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось удалить сообщение {message_id}: {e}")
+        return
+    # Иначе ставим таймер и не задерживаем обработчик
+    await delayed_deleter.schedule(bot, chat_id, message_id, delay)
 
 #В случаях, когда есть вероятность, что пользователь нажмет на одну кнопку несколько раз
 async def safe_edit_message(bot, chat_id, message_id, text, reply_markup=None, parse_mode=None):
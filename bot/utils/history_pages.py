@@ -1,22 +1,54 @@
+from datetime import datetime, timedelta
 from telebot import types
-from database.client import get_user_history
+from config import HISTORY_PAGE_SIZE
+from database.client import get_history_page, get_history_count
+from utils.helpers import safe_edit_message
 
-async def show_history_page(bot, chat_id, user_id, page_index):
-    PAGE_SIZE = 2
-    history = await get_user_history(user_id)
-    total_items = len(history)
-    total_pages = (total_items + PAGE_SIZE - 1) // PAGE_SIZE  # округление вверх
+# Курсор в callback_data — миллисекунды от эпохи: бд хранит время с точностью до миллисекунд,
+# а наивный datetime так переводится без поправки на часовой пояс
+EPOCH = datetime(1970, 1, 1)
 
-    if page_index < 0 or page_index >= total_pages:
-        await bot.send_message(chat_id, "⛔ Это конец истории.")
-        return
 
-    start_idx = page_index * PAGE_SIZE
-    end_idx = min(start_idx + PAGE_SIZE, total_items)
-    current_page = history[start_idx:end_idx]
+def encode_cursor(timestamp):
+    return (timestamp - EPOCH) // timedelta(milliseconds=1)
 
-    response = f"📖 История запросов:\n\n"
-    for item in current_page:
+
+def decode_cursor(value):
+    return EPOCH + timedelta(milliseconds=int(value))
+
+
+async def show_history_page(bot, chat_id, user_id, page_index=0, direction=None, cursor=None, message_id=None):
+    """
+    Показывает страницу истории, от новых записей к старым.
+    direction "next" — записи старше cursor, "prev" — новее; без курсора — первая страница.
+    Страница читается одним запросом по индексу (на запись больше, чтобы узнать, есть ли следующая).
+    С message_id сообщение редактируется на месте, иначе отправляется новое.
+    Возвращает False, если на странице нет записей.
+    """
+    limit = HISTORY_PAGE_SIZE + 1
+    if direction == "prev" and cursor is not None:
+        entries = await get_history_page(user_id, limit, after=cursor)
+        has_newer = len(entries) > HISTORY_PAGE_SIZE
+        entries = entries[-HISTORY_PAGE_SIZE:]
+        has_older = True
+        if not has_newer:
+            page_index = 0
+    else:
+        entries = await get_history_page(user_id, limit, before=cursor if direction == "next" else None)
+        has_older = len(entries) > HISTORY_PAGE_SIZE
+        entries = entries[:HISTORY_PAGE_SIZE]
+        has_newer = cursor is not None and direction == "next"
+        if not has_newer:
+            page_index = 0
+
+    if not entries:
+        return False
+
+    total_items = await get_history_count(user_id)
+    total_pages = max((total_items + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, page_index + 1)  # округление вверх
+
+    response = f"📖 История запросов (страница {page_index + 1} из {total_pages}):\n\n"
+    for item in entries:
         date_str = item["timestamp"].strftime("%d.%m.%Y")
         response += f"🕒 {date_str}\n\n👤 {item['query']}\n🤖 {item['response']}\n\n"
 
@@ -24,10 +56,12 @@ async def show_history_page(bot, chat_id, user_id, page_index):
     markup = types.InlineKeyboardMarkup()
     buttons = []
 
-    if page_index > 0:
-        buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"history_prev_{page_index}"))
-    if end_idx < total_items:
-        buttons.append(types.InlineKeyboardButton("➡️ Вперёд", callback_data=f"history_next_{page_index}"))
+    if has_newer:
+        first = encode_cursor(entries[0]["timestamp"])
+        buttons.append(types.InlineKeyboardButton("⬅️ Назад", callback_data=f"history_prev_{page_index}_{first}"))
+    if has_older:
+        last = encode_cursor(entries[-1]["timestamp"])
+        buttons.append(types.InlineKeyboardButton("➡️ Вперёд", callback_data=f"history_next_{page_index}_{last}"))
 
     if buttons:
         markup.row(*buttons)
@@ -36,5 +70,8 @@ async def show_history_page(bot, chat_id, user_id, page_index):
     clear_button = types.InlineKeyboardButton("🗑 Очистить историю", callback_data="clear_history")
     markup.add(back_button, clear_button)
 
-    # Отправляем новое сообщение (или редактируем старое)
-    await bot.send_message(chat_id, response, reply_markup=markup)
\ No newline at end of file
+    if message_id is not None:
+        await safe_edit_message(bot, chat_id, message_id, response, markup)
+    else:
+        await bot.send_message(chat_id, response, reply_markup=markup)
+    return True
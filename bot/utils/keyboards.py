@@ -78,11 +78,12 @@ def create_inline_menu(buttons):
     return markup
 
 
-async def create_ai_keyboard(user_id, ai_handlers):
+async def create_ai_keyboard(user_id, ai_handlers, user_data=None):
     markup = types.InlineKeyboardMarkup()
     
-    # Получаем текущую модель из БД
-    user_data = await get_user_info(user_id)
+    # Получаем текущую модель из БД, если документ не передан вызывающим обработчиком
+    if user_data is None:
+        user_data = await get_user_info(user_id)
     current_model_key = user_data.get("ai_model", "gpt-4o")
     is_subscribed = user_data.get("is_subscribed", False)
 
@@ -117,10 +118,11 @@ async def create_ai_keyboard(user_id, ai_handlers):
     return markup
 
 
-async def create_role_keyboard(user_id):
+async def create_role_keyboard(user_id, user_data=None):
     markup = types.InlineKeyboardMarkup()
 
-    user_data = await get_user_info(user_id)
+    if user_data is None:
+        user_data = await get_user_info(user_id)
     current_role_key = user_data.get("role", "tarot_reader")
     is_subscribed = user_data.get("is_subscribed", False)
 
@@ -192,6 +194,12 @@ def create_payment_renew_keyboard():
     markup.add(btn)
     return markup
 
+# Отмена отчёта в очереди администратора
+def create_report_cancel_keyboard(job_id):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(types.InlineKeyboardButton("❌ Отменить", callback_data=f"cancel_report:{job_id}"))
+    return markup
+
 # Админ-панель
 def create_admin_keyboard():
     markup = types.InlineKeyboardMarkup(row_width=1)
@@ -200,5 +208,6 @@ def create_admin_keyboard():
     btn_grant_subs = types.InlineKeyboardButton("💳 Выдать подписку", callback_data="admin_grant_subs")
     btn_revoke_subs = types.InlineKeyboardButton("🚫 Забрать подписку", callback_data="admin_revoke_subscription")
     btn_maintenance = types.InlineKeyboardButton("🔧 Рассылка о тех. обслуживании", callback_data="admin_send_maintenance")
-    markup.add(btn_list_users, btn_list_process_export, btn_grant_subs, btn_revoke_subs, btn_maintenance)
+    btn_usage_report = types.InlineKeyboardButton("💰 Расход токенов", callback_data="admin_usage_report")
+    markup.add(btn_list_users, btn_list_process_export, btn_grant_subs, btn_revoke_subs, btn_maintenance, btn_usage_report)
     return markup
\ No newline at end of file
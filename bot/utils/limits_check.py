@@ -1,25 +1,60 @@
-from datetime import datetime
+from pymongo import ReturnDocument
 from config import AI_PRESETS, AI_REQUEST_LIMIT, ADMINS
-from database.client import users_collection, get_user_info
+from database.client import get_user_info, update_user, users_collection, user_cache, invalidate_user_cache
 from utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-async def check_ai_usage(user_id, ai_model_key):
-    now = datetime.now()
-    user_data = await get_user_info(user_id)
-    is_subscribed = user_data.get("is_subscribed", False)
+
+def limit_reached_message(ai_model_key):
+    return f"❌ Лимит использования {AI_PRESETS[ai_model_key]['name']} исчерпан"
+
+
+async def check_ai_usage(user_id, ai_model_key, user_data=None):
+    """Проверка лимита без списания — для мест, где сам запрос к модели будет позже."""
+    if user_data is None:
+        user_data = await get_user_info(user_id)
 
     limits = user_data.get("request_limits", {})
     model_limit = limits.get(ai_model_key, {"count": 0})
 
     if model_limit["count"] >= AI_REQUEST_LIMIT and user_id not in ADMINS:
-        return False, f"❌ Лимит использования {AI_PRESETS[ai_model_key]['name']} исчерпан"
+        return False, limit_reached_message(ai_model_key)
+    return True, ""
+
 
-    # Увеличиваем счетчик
-    users_collection.update_one(
-        {"user_id": user_id},
-        {"$inc": {f"request_limits.{ai_model_key}.count": 1}}
+async def reserve_ai_request(user_id, ai_model_key):
+    """
+    Резервирует один запрос к модели. Проверка лимита и увеличение счётчиков
+    (request_limits и monthly_usage) идут одной условной записью, поэтому параллельные
+    сообщения не могут превысить лимит. Если запрос к ИИ не удался — refund_ai_request.
+    """
+    limit_field = f"request_limits.{ai_model_key}.count"
+    query = {"user_id": user_id}
+    if user_id not in ADMINS:
+        # $not + $gte пропускает и тех, у кого счётчика ещё нет
+        query[limit_field] = {"$not": {"$gte": AI_REQUEST_LIMIT}}
+
+    user_data = await users_collection.find_one_and_update(
+        query,
+        {"$inc": {limit_field: 1, f"monthly_usage.{ai_model_key}": 1}},
+        return_document=ReturnDocument.AFTER
     )
+    if user_data is None:
+        invalidate_user_cache(user_id)
+        return False, limit_reached_message(ai_model_key)
+
+    user_cache[user_id] = user_data
+    return True, ""
+
 
-    return True, ""
\ No newline at end of file
+async def refund_ai_request(user_id, ai_model_key):
+    """Возвращает зарезервированный запрос, если ответ от ИИ так и не получен."""
+    try:
+        await update_user(user_id, {"$inc": {
+            f"request_limits.{ai_model_key}.count": -1,
+            f"monthly_usage.{ai_model_key}": -1,
+        }})
+        logger.info(f"↩️ Запрос к {ai_model_key} возвращён пользователю {user_id}")
+    except Exception as e:
+        logger.error(f"❌ Не удалось вернуть запрос к {ai_model_key} пользователю {user_id}: {e}")
@@ -1,20 +1,130 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import queue
+import random
 import sys
 import os
+from datetime import datetime
+from config import (
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_ROTATION,
+    LOG_MAX_BYTES,
+    LOG_ROTATE_WHEN,
+    LOG_BACKUP_COUNT,
+    LOG_SAMPLE_RATE,
+)
 
 LOGS_DIR = "logs"
 LOG_FILE = os.path.join(LOGS_DIR, "app.log")
 os.makedirs(LOGS_DIR, exist_ok=True)
 
+# Поля, которые есть у любой записи; всё остальное пришло через extra и попадает в JSON
+STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sampled"}
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE, encoding='utf-8'),
-        logging.StreamHandler()  # Логи также будут выводиться в консоль
-    ]
-)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Готовит запись к передаче в поток записи: подставляет аргументы в сообщение
+    и превращает исключение в текст, сохраняя поля из extra.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON. Поля из extra (user_id, model, latency...) идут отдельными ключами."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает только долю LOG_SAMPLE_RATE частых событий — записей с extra={"sampled": True}.
+    Предупреждения и ошибки не отбрасываются никогда.
+    """
+
+    def filter(self, record):
+        if getattr(record, "sampled", False) and record.levelno < logging.WARNING:
+            return random.random() < LOG_SAMPLE_RATE
+        return True
+
+
+def create_file_handler():
+    if LOG_ROTATION == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def parse_module_levels(value):
+    levels = {}
+    for item in value.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging():
+    """
+    Обработчики запускаются в отдельном потоке QueueListener: event loop только кладёт запись в очередь,
+    а запись на диск и в консоль происходит вне его.
+    """
+    console_handler = logging.StreamHandler()  # Логи также будут выводиться в консоль
+    console_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    listener = logging.handlers.QueueListener(
+        log_queue, create_file_handler(), console_handler, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+    for name, level in parse_module_levels(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener.start()
+    # Дописываем очередь при выходе; atexit вызывает обработчики в обратном порядке,
+    # поэтому этот сработает после остальных и сохранит их записи
+    atexit.register(listener.stop)
+    return listener
+
+
+log_listener = setup_logging()
 
 
 def get_logger(name: str) -> logging.Logger:
@@ -26,6 +136,6 @@ def handle_exception(exc_type, exc_value, exc_traceback):
         # Вызовы Ctrl+C не логируем
         return sys.__excepthook__(exc_type, exc_value, exc_traceback)
     logging.error("Необработанное исключение", exc_info=(exc_type, exc_value, exc_traceback))
-    
+
 # Перехватываем все необработанные исключения
 sys.excepthook = handle_exception
@@ -0,0 +1,321 @@
+"""
+Метрики бота в текстовом формате Prometheus.
+Счётчики, гистограммы и показатели пишутся из обработчиков, а снимает их
+Prometheus с локального HTTP-эндпоинта /metrics (METRICS_HOST:METRICS_PORT).
+Часть показателей (глубина очередей и буферов) считается в момент запроса через set_function.
+"""
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+from pymongo import monitoring
+from telebot import asyncio_helper
+from config import METRICS_ENABLED, METRICS_HOST, METRICS_PORT
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Границы гистограмм в секундах: от быстрых запросов к бд до долгих ответов ИИ
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        # Команды Mongo отслеживаются из потоков драйвера, поэтому запись под блокировкой
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.render_samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        return [f"{self.name}_total{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """
+        Значение считается при каждом снятии метрик.
+        function() возвращает число или, для показателя с метками, словарь {кортеж меток: число}.
+        """
+        self.function = function
+
+    def render_samples(self):
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось вычислить метрику {self.name}: {e}")
+                return []
+            items = result.items() if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = list(self.values.items())
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self.values.get(key)
+            if series is None:
+                # Счётчики по корзинам (не накопительные), сумма и количество
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def render_samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- Telegram ---
+UPDATES = Counter("bot_updates", "Полученные обновления Telegram", ["type"])
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Время обработки пачки обновлений Telegram", ["type"])
+TELEGRAM_API_SECONDS = Histogram("telegram_api_seconds", "Длительность вызовов Bot API", ["method"])
+
+# --- Хранилище ---
+MONGO_COMMAND_SECONDS = Histogram("mongo_command_seconds", "Длительность команд MongoDB", ["command"])
+
+# --- Провайдеры ИИ ---
+PROVIDER_REQUEST_SECONDS = Histogram("provider_request_seconds", "Длительность запросов к провайдерам ИИ", ["provider", "model", "outcome"])
+PROVIDER_QUEUE_SECONDS = Histogram("provider_queue_wait_seconds", "Ожидание в очереди к провайдеру", ["provider"])
+SPEECH_SECONDS = Histogram("speech_seconds", "Распознавание и синтез речи", ["kind", "outcome"])
+
+# --- Обработка запроса пользователя ---
+REQUEST_STAGE_SECONDS = Histogram("request_stage_seconds", "Этапы обработки запроса к ИИ", ["stage"])
+ACTIVE_REQUESTS = Gauge("bot_active_requests", "Запросы к ИИ, которые сейчас обрабатываются")
+
+# --- Ошибки ---
+ERRORS = Counter("bot_errors", "Ошибки по месту возникновения и типу", ["component", "error"])
+
+# --- Очереди и буферы (значения считаются при снятии метрик) ---
+PROVIDER_QUEUE_DEPTH = Gauge("provider_queue_depth", "Запросы в очереди к провайдеру", ["provider"])
+PROVIDER_IN_FLIGHT = Gauge("provider_in_flight", "Запросы, выполняющиеся у провайдера", ["provider"])
+WEBHOOK_QUEUE_DEPTH = Gauge("webhook_queue_depth", "Обновления в очереди webhook")
+PENDING_WRITES = Gauge("pending_writes", "Отложенные записи в бд", ["buffer"])
+DELAYED_DELETIONS = Gauge("delayed_deletions", "Сообщения, ожидающие автоудаления")
+BACKGROUND_TASKS = Gauge("background_tasks", "Фоновые задачи вне пути ответа")
+
+
+def count_error(component, error):
+    ERRORS.inc(component=component, error=type(error).__name__)
+
+
+@contextmanager
+def track(histogram, component, **labels):
+    """Замеряет блок с меткой outcome=ok|error|cancelled; ошибка также попадает в bot_errors."""
+    started_at = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        outcome = "error"
+        count_error(component, e)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started_at, outcome=outcome, **labels)
+
+
+def record_stages(timer):
+    for stage, duration in timer.stages.items():
+        REQUEST_STAGE_SECONDS.observe(duration, stage=stage)
+    REQUEST_STAGE_SECONDS.observe(timer.total(), stage="total")
+
+
+def get_update_type(update):
+    for field in ("message", "callback_query", "pre_checkout_query", "edited_message", "my_chat_member"):
+        if getattr(update, field, None) is not None:
+            return field
+    return "other"
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Замеряет все команды драйвера MongoDB; подключается при создании клиента."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, command=event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1_000_000, command=event.command_name)
+        ERRORS.inc(component="mongo", error=event.failure.get("codeName", "CommandFailed"))
+
+
+def instrument_telegram_api():
+    """Оборачивает отправку запросов в Bot API, чтобы замерять все методы в одном месте."""
+    original = asyncio_helper._process_request
+    if getattr(original, "instrumented", False):
+        return
+
+    async def process_request(token, url, *args, **kwargs):
+        # getUpdates — длинный опрос, его время ничего не говорит о задержках
+        if url == "getUpdates":
+            return await original(token, url, *args, **kwargs)
+        started_at = time.perf_counter()
+        try:
+            return await original(token, url, *args, **kwargs)
+        except Exception as e:
+            ERRORS.inc(component="telegram", error=f"{url}:{getattr(e, 'error_code', type(e).__name__)}")
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started_at, method=url)
+
+    process_request.instrumented = True
+    asyncio_helper._process_request = process_request
+
+
+def instrument_bot(bot):
+    """Замеры обработки обновлений: и polling, и webhook передают их в process_new_updates."""
+    original = bot.process_new_updates
+
+    async def process_new_updates(updates):
+        update_types = [get_update_type(update) for update in updates]
+        for update_type in update_types:
+            UPDATES.inc(type=update_type)
+        # Webhook передаёт обновления по одному, polling — пачкой; пачку помечаем типом первого
+        started_at = time.perf_counter()
+        try:
+            return await original(updates)
+        finally:
+            if update_types:
+                UPDATE_SECONDS.observe(time.perf_counter() - started_at, type=update_types[0])
+
+    bot.process_new_updates = process_new_updates
+    instrument_telegram_api()
+
+
+class MetricsServer:
+    def __init__(self):
+        self.runner = None
+
+    async def handle_metrics(self, request: web.Request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        if not METRICS_ENABLED:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, METRICS_HOST, METRICS_PORT).start()
+        except OSError as e:
+            logger.error(f"❌ Не удалось открыть порт метрик {METRICS_HOST}:{METRICS_PORT}: {e}")
+            await self.runner.cleanup()
+            self.runner = None
+            return
+        logger.info(f"📈 Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+metrics_server = MetricsServer()
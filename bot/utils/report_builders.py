@@ -0,0 +1,51 @@
+"""
+Построение файлов отчётов для администратора.
+Функции выполняются в процессах ReportJobRunner, поэтому принимают и возвращают
+только простые данные (списки кортежей, bytes) и не обращаются к боту или бд.
+"""
+from io import BytesIO
+from openpyxl import Workbook
+from openpyxl.styles import Alignment
+from openpyxl.utils import get_column_letter
+
+
+def build_table_xlsx(sheet_name, headers, rows, centered_columns=(), max_width=30, wrap_after=20,
+                     tall_after=50, max_row_height=150):
+    """
+    Таблица xlsx за один проход по строкам: выравнивание ячеек, ширина колонок и высота строк
+    считаются по ходу записи, без повторных обходов листа.
+    centered_columns — номера колонок (с нуля), выровненных по центру.
+    """
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = sheet_name
+
+    # Один объект стиля на вариант, а не на каждую ячейку
+    alignments = {
+        (centered, wrap): Alignment(horizontal="center" if centered else "left", vertical="top", wrap_text=wrap)
+        for centered in (False, True) for wrap in (False, True)
+    }
+    centered = [i in centered_columns for i in range(len(headers))]
+    widths = [0] * len(headers)
+
+    for row_index, row in enumerate([headers, *rows], start=1):
+        sheet.append(row)
+        height = None
+        for column_index, value in enumerate(row):
+            text = "" if value is None else str(value)
+            widths[column_index] = max(widths[column_index], len(text))
+
+            wrap = isinstance(value, str) and len(value) > wrap_after
+            sheet.cell(row=row_index, column=column_index + 1).alignment = alignments[(centered[column_index], wrap)]
+
+            if isinstance(value, str) and len(value) > tall_after:
+                height = max(height or 0, min(max_row_height, len(value) // 4 * 15))
+        if height:
+            sheet.row_dimensions[row_index].height = height
+
+    for column_index, width in enumerate(widths, start=1):
+        sheet.column_dimensions[get_column_letter(column_index)].width = min(width + 2, max_width)
+
+    output = BytesIO()
+    workbook.save(output)
+    return output.getvalue()
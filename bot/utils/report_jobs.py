@@ -0,0 +1,131 @@
+import asyncio
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from config import REPORT_WORKERS, REPORT_MAX_JOBS, REPORT_QUEUE_SIZE
+from utils.helpers import safe_edit_message, auto_delete_message
+from utils.keyboards import create_report_cancel_keyboard
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class ReportJob:
+    def __init__(self, job_id, chat_id, title, make_coro):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.title = title
+        # Корутина создаётся только при запуске: отчёт, отменённый в очереди, не оставит незапущенной корутины
+        self.make_coro = make_coro
+        self.status_message_id = None
+        self.task = None
+
+
+class ReportJobRunner:
+    """
+    Очередь отчётов администратора. Одновременно выполняется не больше REPORT_MAX_JOBS отчётов,
+    остальные ждут в очереди (до REPORT_QUEUE_SIZE). Тяжёлое построение файлов уходит
+    в пул из REPORT_WORKERS процессов через run_in_process, поэтому не занимает event loop.
+    Ход выполнения показывается в служебном сообщении с кнопкой отмены.
+    """
+
+    def __init__(self):
+        self.queue = deque()
+        self.running = {}
+        self._ids = itertools.count(1)
+        self._executor = None
+        self.bot = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # Не fork: к этому моменту в процессе уже работают потоки (логи, мониторы mongo, выгрузки),
+            # и скопированная в дочерний процесс занятая блокировка может его повесить
+            self._executor = ProcessPoolExecutor(
+                max_workers=REPORT_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._executor
+
+    async def run_in_process(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), partial(function, *args, **kwargs))
+
+    async def submit(self, bot, chat_id, title, make_coro):
+        """make_coro — функция без аргументов, возвращающая корутину отчёта."""
+        self.bot = bot
+        if len(self.queue) >= REPORT_QUEUE_SIZE:
+            msg = await bot.send_message(chat_id, "⏳ Очередь отчётов заполнена, попробуйте позже")
+            await auto_delete_message(bot, chat_id, msg.message_id, 5)
+            return None
+
+        job = ReportJob(next(self._ids), chat_id, title, make_coro)
+        self.queue.append(job)
+        msg = await bot.send_message(
+            chat_id, self._queued_text(job), reply_markup=create_report_cancel_keyboard(job.id)
+        )
+        job.status_message_id = msg.message_id
+        self._dispatch()
+        return job
+
+    def _queued_text(self, job):
+        position = next((i for i, queued in enumerate(self.queue, start=1) if queued is job), None)
+        if position is None:
+            return f"⚙️ Формируется отчёт «{job.title}»"
+        return f"🕓 Отчёт «{job.title}» в очереди: {position}"
+
+    def _dispatch(self):
+        while self.queue and len(self.running) < REPORT_MAX_JOBS:
+            job = self.queue.popleft()
+            job.task = asyncio.create_task(self._run(job))
+            self.running[job.id] = job
+
+    async def _update_status(self, job, text, with_cancel=True):
+        if job.status_message_id is None:
+            return
+        markup = create_report_cancel_keyboard(job.id) if with_cancel else None
+        await safe_edit_message(self.bot, job.chat_id, job.status_message_id, text, reply_markup=markup)
+
+    async def _run(self, job):
+        try:
+            await self._update_status(job, self._queued_text(job))
+            await job.make_coro()
+            if job.status_message_id is not None:
+                await auto_delete_message(self.bot, job.chat_id, job.status_message_id, 0)
+        except asyncio.CancelledError:
+            await self._update_status(job, f"❌ Отчёт «{job.title}» отменён", with_cancel=False)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при формировании отчёта «{job.title}»: {e}")
+            await self._update_status(job, f"❌ Не удалось сформировать отчёт «{job.title}»", with_cancel=False)
+        finally:
+            self.running.pop(job.id, None)
+            self._dispatch()
+            # Остальным в очереди сообщаем новое место
+            for queued in list(self.queue):
+                await self._update_status(queued, self._queued_text(queued))
+
+    async def cancel(self, job_id):
+        for job in self.queue:
+            if job.id == job_id:
+                self.queue.remove(job)
+                await self._update_status(job, f"❌ Отчёт «{job.title}» отменён", with_cancel=False)
+                return True
+        job = self.running.get(job_id)
+        if job is None:
+            return False
+        # Построение в процессе пула не прерывается, но его результат будет отброшен
+        job.task.cancel()
+        return True
+
+    async def shutdown(self):
+        self.queue.clear()
+        tasks = [job.task for job in self.running.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+report_runner = ReportJobRunner()
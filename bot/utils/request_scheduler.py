@@ -0,0 +1,197 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from config import (
+    PROVIDER_MAX_CONCURRENCY,
+    PROVIDER_TOKENS_PER_MINUTE,
+    SUBSCRIBER_QUEUE_WEIGHT,
+    QUEUE_POSITION_INTERVAL,
+)
+from utils.rate_limit import TokenBucket
+from utils.metrics import PROVIDER_QUEUE_DEPTH, PROVIDER_IN_FLIGHT
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+def estimate_request_tokens(messages, role):
+    """Грубая оценка стоимости запроса в токенах: ~3 символа на токен плюс максимум ответа."""
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 3 + role.get("max_tokens", 800)
+
+
+class QueueWaiter:
+    def __init__(self, user_id, tokens, on_position):
+        self.user_id = user_id
+        self.tokens = tokens
+        self.on_position = on_position
+        self.future = asyncio.get_running_loop().create_future()
+        self.cancelled = False
+        self.position = None
+        self.reported_at = 0.0
+
+
+class ProviderQueue:
+    """
+    Очередь запросов к одному провайдеру: не больше max_concurrency одновременных вызовов,
+    бюджет токенов в минуту и взвешенная справедливая очередь (WFQ) — запрос подписчика
+    «стоит» в SUBSCRIBER_QUEUE_WEIGHT раз меньше виртуального времени, чем бесплатный.
+    """
+
+    def __init__(self, provider, max_concurrency, tokens_per_minute):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+        self.in_flight = 0
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        self.waiters = []
+        self._counter = itertools.count()
+        self._wakeup = None
+        self._positions_timer = None
+        # Ссылки на задачи уведомлений, чтобы их не собрал сборщик мусора до завершения
+        self._notify_tasks = set()
+
+    @property
+    def depth(self):
+        return sum(1 for _, _, waiter in self.waiters if not waiter.cancelled)
+
+    async def acquire(self, user_id, tokens, weight, on_position=None):
+        previous_finish = self.last_finish.get(user_id, 0.0)
+        start = max(self.virtual_time, previous_finish)
+        finish = start + tokens / weight
+        self.last_finish[user_id] = finish
+
+        waiter = QueueWaiter(user_id, tokens, on_position)
+        heapq.heappush(self.waiters, (finish, next(self._counter), waiter))
+        self._dispatch()
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже выдан, но запрос отменили — возвращаем слот
+                self.release()
+            else:
+                waiter.cancelled = True
+                # Отменённый запрос не должен отодвигать следующие запросы пользователя
+                if self.last_finish.get(user_id) == finish:
+                    if previous_finish > self.virtual_time:
+                        self.last_finish[user_id] = previous_finish
+                    else:
+                        del self.last_finish[user_id]
+                self._dispatch()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.waiters and self.in_flight < self.max_concurrency:
+            finish, _, waiter = self.waiters[0]
+            if waiter.cancelled:
+                heapq.heappop(self.waiters)
+                continue
+
+            if self.bucket and not self.bucket.try_consume(waiter.tokens):
+                # Бюджет токенов исчерпан — разбудим очередь, когда он восполнится
+                self._schedule_wakeup(self.bucket.time_until(waiter.tokens))
+                break
+
+            heapq.heappop(self.waiters)
+            self.in_flight += 1
+            self.virtual_time = finish
+            if self.last_finish.get(waiter.user_id) == finish:
+                del self.last_finish[waiter.user_id]
+            waiter.future.set_result(True)
+
+        self._report_positions()
+
+    def _schedule_wakeup(self, delay):
+        if self._wakeup is not None:
+            return
+
+        def wakeup():
+            self._wakeup = None
+            self._dispatch()
+
+        self._wakeup = asyncio.get_running_loop().call_later(delay, wakeup)
+
+    def _report_positions(self):
+        now = time.monotonic()
+        retry_in = None
+        active = sorted(entry for entry in self.waiters if not entry[2].cancelled)
+        for position, (_, _, waiter) in enumerate(active, start=1):
+            if waiter.on_position is None or waiter.position == position or waiter.future.done():
+                continue
+            wait = QUEUE_POSITION_INTERVAL - (now - waiter.reported_at)
+            if wait > 0:
+                # Отложенное место сообщим позже, даже если очередь до тех пор не сдвинется
+                retry_in = wait if retry_in is None else min(retry_in, wait)
+                continue
+            waiter.position = position
+            waiter.reported_at = now
+            task = asyncio.create_task(self._notify(waiter, position))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+        if retry_in is not None:
+            self._schedule_positions_report(retry_in)
+
+    def _schedule_positions_report(self, delay):
+        if self._positions_timer is not None:
+            return
+
+        def report():
+            self._positions_timer = None
+            self._report_positions()
+
+        self._positions_timer = asyncio.get_running_loop().call_later(delay, report)
+
+    async def _notify(self, waiter, position):
+        # Запрос уже получил слот или отменён — заглушка больше не показывает очередь
+        if waiter.future.done() or waiter.cancelled:
+            return
+        try:
+            await waiter.on_position(position)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сообщить место в очереди: {e}")
+
+
+class RequestScheduler:
+    """Очереди ко всем провайдерам ИИ."""
+
+    def __init__(self):
+        self.queues = {}
+
+    def get_queue(self, provider):
+        queue = self.queues.get(provider)
+        if queue is None:
+            queue = ProviderQueue(
+                provider,
+                PROVIDER_MAX_CONCURRENCY.get(provider, DEFAULT_MAX_CONCURRENCY),
+                PROVIDER_TOKENS_PER_MINUTE.get(provider, 0),
+            )
+            self.queues[provider] = queue
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, provider, user_id, tokens, is_subscribed=False, on_position=None):
+        queue = self.get_queue(provider)
+        weight = SUBSCRIBER_QUEUE_WEIGHT if is_subscribed else 1
+        await queue.acquire(user_id, tokens, weight, on_position)
+        try:
+            yield
+        finally:
+            queue.release()
+
+
+request_scheduler = RequestScheduler()
+
+PROVIDER_QUEUE_DEPTH.set_function(lambda: {(p,): q.depth for p, q in request_scheduler.queues.items()})
+PROVIDER_IN_FLIGHT.set_function(lambda: {(p,): q.in_flight for p, q in request_scheduler.queues.items()})
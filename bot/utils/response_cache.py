@@ -0,0 +1,109 @@
+import hashlib
+import json
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from cachetools import LRUCache
+from pymongo import ASCENDING, IndexModel
+from config import (
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_DEFAULT_TTL,
+    RESPONSE_CACHE_MAX_TEMPERATURE,
+    RESPONSE_CACHE_MONGO,
+)
+from database.client import db
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+cache_collection = db["response_cache"]
+
+CACHE_INDEXES = [IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0)]
+
+
+async def create_cache_indexes():
+    await cache_collection.create_indexes(CACHE_INDEXES)
+
+
+def normalize_prompt(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def get_cache_ttl(role):
+    """Сколько секунд хранить ответ для роли; 0 — роль не кэшируется."""
+    if role.get("temperature", 1.0) >= RESPONSE_CACHE_MAX_TEMPERATURE:
+        # У «творческих» ролей одинаковый ответ на повторный вопрос был бы заметен
+        return 0
+    return role.get("cache_ttl", RESPONSE_CACHE_DEFAULT_TTL)
+
+
+def make_cache_key(model_key, messages):
+    """
+    Ключ: модель, системный промпт и история (всё, кроме последнего сообщения)
+    и нормализованный текст нового запроса.
+    """
+    context_hash = hashlib.sha256(
+        json.dumps(messages[:-1], ensure_ascii=False, sort_keys=True).encode()
+    ).hexdigest()
+    prompt = normalize_prompt(messages[-1]["content"])
+    return hashlib.sha256(f"{model_key}\n{context_hash}\n{prompt}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов ИИ: LRU в памяти и, если включено RESPONSE_CACHE_MONGO,
+    общий для всех экземпляров бота уровень в MongoDB.
+    """
+
+    def __init__(self):
+        # key -> (ответ, момент истечения по time.monotonic)
+        self.memory = LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            response, expires_at = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                return response
+            self.memory.pop(key, None)
+
+        if RESPONSE_CACHE_MONGO:
+            try:
+                doc = await cache_collection.find_one(
+                    {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}}
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Кэш ответов в бд недоступен: {e}")
+                doc = None
+            if doc is not None:
+                ttl = (doc["expires_at"].replace(tzinfo=timezone.utc) - datetime.now(timezone.utc)).total_seconds()
+                self.memory[key] = (doc["response"], time.monotonic() + ttl)
+                self.hits += 1
+                return doc["response"]
+
+        self.misses += 1
+        return None
+
+    async def set(self, key, response, ttl):
+        if ttl <= 0:
+            return
+        self.memory[key] = (response, time.monotonic() + ttl)
+
+        if RESPONSE_CACHE_MONGO:
+            try:
+                await cache_collection.update_one(
+                    {"_id": key},
+                    {"$set": {
+                        "response": response,
+                        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl),
+                    }},
+                    upsert=True
+                )
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось сохранить ответ в кэш бд: {e}")
+
+
+response_cache = ResponseCache()
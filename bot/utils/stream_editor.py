@@ -0,0 +1,82 @@
+import asyncio
+import telebot
+from config import STREAM_EDIT_INTERVAL
+from utils.helpers import safe_edit_message, clean_ai_response
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Ограничение Telegram на длину текста сообщения
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_CURSOR = " ▌"
+
+
+class StreamingMessageEditor:
+    """
+    Постепенно выводит ответ ИИ в одно сообщение Telegram.
+    Куски ответа копятся в буфере, а сообщение редактируется не чаще,
+    чем раз в min_interval секунд — так не упираемся в лимиты на редактирование.
+    """
+
+    def __init__(self, bot, chat_id, message_id, min_interval=STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.text = ""
+        self._last_sent = ""
+        self._last_edit_at = 0.0
+        self._flush_task = None
+
+    async def push(self, delta):
+        """Колбэк для send_to_*: принимает очередной кусок ответа."""
+        self.text += delta
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        loop = asyncio.get_running_loop()
+        delay = self._last_edit_at + self.min_interval - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        preview = clean_ai_response(self.text)
+        if len(preview) + len(STREAM_CURSOR) > TELEGRAM_MESSAGE_LIMIT:
+            preview = preview[:TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR) - 1] + "…"
+        if not preview or preview == self._last_sent:
+            return
+
+        self._last_edit_at = loop.time()
+        self._last_sent = preview
+        # Промежуточный текст без parse_mode: незакрытые теги сломали бы разметку
+        await safe_edit_message(self.bot, self.chat_id, self.message_id, preview + STREAM_CURSOR)
+
+    async def finish(self, final_text, parse_mode="HTML"):
+        """
+        Записывает в сообщение окончательный ответ.
+        Возвращает False, если отредактировать не удалось (например, ответ длиннее лимита),
+        и тогда ответ нужно отправить отдельным сообщением.
+        """
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+
+        if len(final_text) > TELEGRAM_MESSAGE_LIMIT:
+            return False
+
+        try:
+            await self.bot.edit_message_text(
+                text=final_text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=parse_mode
+            )
+        except telebot.apihelper.ApiTelegramException as e:
+            if "message is not modified" in str(e):
+                return True
+            logger.warning(f"⚠️ Не удалось записать итоговый ответ в сообщение {self.message_id}: {e}")
+            return False
+        return True
@@ -1,105 +1,99 @@
+import asyncio
 from telebot.types import LabeledPrice
 from telebot.async_telebot import AsyncTeleBot
 from telebot.apihelper import ApiTelegramException
 from datetime import timedelta, datetime
-from database.client import get_all_users_with_subscription, get_user_info
+from database.client import iter_expiring_subscriptions, claim_renewal_notice, release_renewal_notice
 from utils.logger import get_logger
 from utils.keyboards import create_payment_renew_keyboard
-from config import SUBSCRIPTION_PRICE
+from config import SUBSCRIPTION_PRICE, SUBSCRIPTION_CHECK_INTERVAL
 
 logger = get_logger(__name__)
 
-async def check_subscriptions_expiry(bot: AsyncTeleBot, user_id=0):
-    """
-    Фоновая задача: каждый день проверяет, у кого подписка заканчивается через 1 день
-    """
-    
-    now = datetime.now().date()
-    date_tomorrow = now + timedelta(days=1)
-    
-    if user_id == 0:
-    # Получаем всех пользователей с подпиской
-        logger.info("⏰ Начинаю ежедневную проверку подписок")
-        users = await get_all_users_with_subscription()
 
-        if len(users) == 0:
-            logger.info("😨 Нет пользователей с подпиской")
-            return
-        
-    else:
-        user_data = await get_user_info(user_id)
-        subscription_end = user_data.get("subscription_end")
+async def send_renewal_invoice(bot: AsyncTeleBot, user_id):
+    markup = create_payment_renew_keyboard()
+
+    # Генерируем ссылку на покупку через @invoice
+    title = "Подписка на бота"
+    description = """
+ℹ️Завтра истекает срок вашей подписки. Самое время продлить ее
+‼️ Оформление подписки не подразумевает возврата средств в будущем
+                """
+    payload = f"sub_{user_id}_{int(datetime.now().timestamp())}"
+    currency = "XTR"
+    provider_token=""
+    prices = [LabeledPrice(label="Ежемесячная подписка", amount=SUBSCRIPTION_PRICE)]
+    # photo_url = "https://example.com/subscription_image.jpg "  # Необязательно
 
-        if not user_data:
-            logger.warning(f"❌ Не найден пользователь {user_id}")
-            return
+    await bot.send_invoice(
+            chat_id=int(user_id),
+            title=title,
+            description=description,
+            invoice_payload=payload,
+            currency=currency,
+            prices=prices,
+            provider_token=provider_token,
+            # photo_url=photo_url,
+            is_flexible=False,
+            allow_paid_broadcast=True,  # Разрешаем оплату через Stars
+            reply_markup=markup
+        )
 
-        users = [user_data]  # оборачиваем в список для единообразия
 
-    for user_data in users:
+async def check_subscriptions_expiry(bot: AsyncTeleBot):
+    """
+    Напоминает о продлении тем, у кого подписка заканчивается завтра.
+    Выбираются только такие пользователи (диапазонный запрос по индексу), курсором.
+    Отправленное напоминание отмечается в документе (renewal_notified_for), поэтому
+    повторные проверки и перезапуски не присылают второй счёт.
+    """
+    now = datetime.now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    day_after_tomorrow = tomorrow + timedelta(days=1)
+
+    notified = 0
+    async for user_data in iter_expiring_subscriptions(tomorrow, day_after_tomorrow):
         user_id = user_data["user_id"]
-        subscription_end = user_data.get("subscription_end")
+        subscription_end = user_data["subscription_end"]
 
-        if not subscription_end or subscription_end is None:
+        if user_data.get("renewal_notified_for") == subscription_end:
             continue
 
-        if isinstance(subscription_end, str):
-            try:
-                subscription_end = datetime.fromisoformat(subscription_end).date()
-            except ValueError:
-                logger.warning(f"⚠️ Неверный формат даты у пользователя {user_id}: {subscription_end}")
-                continue
-        elif isinstance(subscription_end, datetime):
-            subscription_end = subscription_end.date()
+        # Неактивным не пишем; если вернутся до конца дня, напомним при следующей проверке
+        last_seen = user_data.get("last_seen", None)
+        if not last_seen or (now - last_seen).days > 1:
+            continue
 
-        if subscription_end.date() < now:
+        # Отметку ставим до отправки: из нескольких экземпляров бота счёт отправит только один
+        if not await claim_renewal_notice(user_id, subscription_end):
             continue
 
-        # Если до конца подписки 1 день
-        if subscription_end.date() == date_tomorrow:
-            try:
-                logger.info(f"🔔 Подписка пользователя {user_id} закончится через 1 день")
-                
-                last_seen = user_data.get("last_seen", None)
-                if not last_seen or (datetime.now() - last_seen).days > 1:
-                    logger.info(f"💤 Пользователь {user_id} давно не писал боту")
-                    continue
-                
-                markup = create_payment_renew_keyboard()
+        try:
+            logger.info(f"🔔 Подписка пользователя {user_id} закончится через 1 день")
+            await send_renewal_invoice(bot, user_id)
+            notified += 1
+        except ApiTelegramException as e:
+            if "bot was blocked by the user" in str(e).lower():
+                logger.warning(f"⛔ Пользователь {user_id} заблокировал бота")
+            elif "chat not found" in str(e).lower():
+                logger.warning(f"❌ Чат {user_id} не найден (пользователь, возможно, не запускал бота)")
+            else:
+                logger.error(f"❗Telegram API ошибка: {e}")
+                await release_renewal_notice(user_id, subscription_end)
+        except Exception as e:
+            logger.error(f"❌ Не удалось отправить уведомление пользователю {user_id}: {e}")
+            await release_renewal_notice(user_id, subscription_end)
 
-                # Генерируем ссылку на покупку через @invoice
-                title = "Подписка на бота"
-                description = """
-ℹ️Завтра истекает срок вашей подписки. Самое время продлить ее
-‼️ Оформление подписки не подразумевает возврата средств в будущем
-                """
-                payload = f"sub_{user_id}_{int(datetime.now().timestamp())}"
-                currency = "XTR"
-                provider_token=""
-                prices = [LabeledPrice(label="Ежемесячная подписка", amount=SUBSCRIPTION_PRICE)]
-                # photo_url = "https://example.com/subscription_image.jpg "  # Необязательно
-                
-                await bot.send_invoice(
-                        chat_id=int(user_id),
-                        title=title,
-                        description=description,
-                        invoice_payload=payload,
-                        currency=currency,
-                        prices=prices,
-                        provider_token=provider_token,
-                        # photo_url=photo_url,
-                        is_flexible=False,
-                        allow_paid_broadcast=True,  # Разрешаем оплату через Stars
-                        reply_markup=markup
-                    )
-            except ApiTelegramException as e:
-                if "bot was blocked by the user" in str(e).lower():
-                    logger.warning(f"⛔ Пользователь {user_id} заблокировал бота")
-                elif "chat not found" in str(e).lower():
-                    logger.warning(f"❌ Чат {user_id} не найден (пользователь, возможно, не запускал бота)")
-                else:
-                    logger.error(f"❗Telegram API ошибка: {e}")
-            except Exception as e:
-                logger.error(f"❌ Не удалось отправить уведомление пользователю {user_id}: {e}")
-        else:
-            logger.info("🔔 Оканчивающихся подписок не найдено")
+    if notified:
+        logger.info(f"🔔 Отправлено напоминаний о продлении подписки: {notified}")
+
+
+async def run_subscription_checks(bot: AsyncTeleBot):
+    """Фоновая задача: проверка каждые SUBSCRIPTION_CHECK_INTERVAL секунд."""
+    while True:
+        try:
+            await check_subscriptions_expiry(bot)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при проверке подписок: {e}")
+        await asyncio.sleep(SUBSCRIPTION_CHECK_INTERVAL)
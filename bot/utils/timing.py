@@ -0,0 +1,33 @@
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Замеры этапов обработки одного запроса.
+    Этапы, идущие параллельно, замеряются каждый отдельно, поэтому их сумма может быть больше total.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - started_at
+
+    async def measure(self, name, awaitable):
+        with self.stage(name):
+            return await awaitable
+
+    def total(self):
+        return time.perf_counter() - self.started_at
+
+    def format(self):
+        parts = [f"{name}={duration * 1000:.0f}мс" for name, duration in self.stages.items()]
+        parts.append(f"всего={self.total() * 1000:.0f}мс")
+        return " ".join(parts)
@@ -0,0 +1,40 @@
+import tiktoken
+from functools import lru_cache
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Кодировки токенизатора по моделям. Для моделей других провайдеров точного
+# токенизатора нет, поэтому считаем по cl100k_base — для бюджета этого достаточно
+MODEL_ENCODINGS = {
+    "gpt-4o": "o200k_base",
+}
+DEFAULT_ENCODING = "cl100k_base"
+
+# Служебные токены, которые добавляет формат chat к каждому сообщению
+TOKENS_PER_MESSAGE = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name):
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:
+        # tiktoken скачивает словарь при первом обращении — без сети считаем приблизительно
+        logger.warning(f"⚠️ Не удалось загрузить токенизатор {encoding_name}: {e}")
+        return None
+
+
+def count_tokens(text, model_key=None):
+    if not text:
+        return 0
+
+    encoding = get_encoding(MODEL_ENCODINGS.get(model_key, DEFAULT_ENCODING))
+    if encoding is None:
+        return len(text) // 3 + 1
+
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(content, model_key=None):
+    return count_tokens(content, model_key) + TOKENS_PER_MESSAGE
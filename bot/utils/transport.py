@@ -0,0 +1,86 @@
+import aiohttp
+import httpx
+from openai import AsyncOpenAI
+from config import (
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_MAX_CONNECTIONS_PER_HOST,
+    HTTP_KEEPALIVE_EXPIRY,
+)
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# HTTP/2 включается, только если установлен пакет h2 (httpx[http2])
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# Долгоживущие пулы соединений к провайдерам ИИ: имя провайдера -> httpx.AsyncClient.
+# Каждый провайдер — отдельный хост, поэтому лимиты пула действуют как лимиты на хост
+_provider_http_clients = {}
+# Общая сессия aiohttp для скачивания файлов (изображения DALL·E и т.п.)
+_http_session = None
+
+
+def get_provider_http_client(provider):
+    http_client = _provider_http_clients.get(provider)
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS_PER_HOST,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+        _provider_http_clients[provider] = http_client
+    return http_client
+
+
+def create_ai_client(provider, api_key, base_url=None):
+    """Создаёт OpenAI-совместимый клиент поверх общего пула соединений провайдера."""
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        http_client=get_provider_http_client(provider),
+    )
+
+
+def get_http_session():
+    # Сессию aiohttp можно создавать только внутри запущенного event loop
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=HTTP_MAX_CONNECTIONS_PER_HOST,
+                keepalive_timeout=HTTP_KEEPALIVE_EXPIRY,
+                ttl_dns_cache=300,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=None,
+                connect=HTTP_CONNECT_TIMEOUT,
+                sock_read=HTTP_READ_TIMEOUT,
+            ),
+        )
+    return _http_session
+
+
+async def close_transport():
+    """Закрывает все пулы соединений. Вызывается при остановке бота."""
+    global _http_session
+    for provider, http_client in list(_provider_http_clients.items()):
+        try:
+            await http_client.aclose()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось закрыть соединения провайдера {provider}: {e}")
+    _provider_http_clients.clear()
+
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
@@ -0,0 +1,136 @@
+import asyncio
+import hmac
+import signal
+from urllib.parse import urlparse
+from aiohttp import web
+from telebot import types
+from telebot.async_telebot import AsyncTeleBot
+from config import (
+    WEBHOOK_URL,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+    WEBHOOK_MAX_CONNECTIONS,
+    WEBHOOK_DRAIN_TIMEOUT,
+)
+from utils.logger import get_logger
+from utils.metrics import WEBHOOK_QUEUE_DEPTH
+
+logger = get_logger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Принимает обновления от Telegram по webhook вместо getUpdates.
+    Запрос только кладёт обновление в ограниченную очередь и сразу отвечает 200,
+    а обрабатывают очередь WEBHOOK_WORKERS воркеров. Если очередь полна, отвечаем 503 —
+    Telegram повторит доставку позже.
+    """
+
+    def __init__(self, bot: AsyncTeleBot):
+        self.bot = bot
+        self.queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self.workers = []
+        self.runner = None
+        self.accepting = False
+        self.path = urlparse(WEBHOOK_URL).path or "/"
+        WEBHOOK_QUEUE_DEPTH.set_function(self.queue.qsize)
+
+    async def handle_update(self, request: web.Request):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+            logger.warning(f"🚫 Webhook: запрос без верного секрета от {request.remote}")
+            return web.Response(status=401)
+
+        if not self.accepting:
+            return web.Response(status=503)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            logger.warning(f"⚠️ Webhook: очередь обновлений заполнена ({WEBHOOK_QUEUE_SIZE}), просим Telegram повторить")
+            return web.Response(status=503)
+
+        return web.Response()
+
+    async def handle_health(self, request: web.Request):
+        return web.json_response({"queue": self.queue.qsize(), "accepting": self.accepting})
+
+    async def worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                update = types.Update.de_json(data)
+                await self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"❌ Ошибка при обработке обновления: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/health", self.handle_health)
+
+        self.runner = web.AppRunner(app, handle_signals=False, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(WEBHOOK_WORKERS)]
+        self.accepting = True
+
+        # Несколько реплик регистрируют один и тот же адрес — повторный вызов безопасен
+        await self.bot.set_webhook(
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"🌐 Webhook запущен на {WEBHOOK_HOST}:{WEBHOOK_PORT}{self.path}, воркеров: {WEBHOOK_WORKERS}")
+
+    async def stop(self):
+        """Перестаёт принимать обновления, дорабатывает очередь и останавливает воркеры."""
+        self.accepting = False
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+        if self.queue.qsize():
+            logger.info(f"⏳ Webhook: дорабатываем очередь ({self.queue.qsize()} обновлений)")
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"⚠️ Webhook: не успели обработать {self.queue.qsize()} обновлений")
+
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        # Webhook у Telegram не снимаем: обновления продолжат получать другие реплики
+        logger.info("🌐 Webhook остановлен")
+
+
+async def run_webhook(bot: AsyncTeleBot):
+    """Запускает webhook-сервер и работает до SIGINT/SIGTERM."""
+    server = WebhookServer(bot)
+    stop_event = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            # Windows: остаётся остановка через KeyboardInterrupt
+            pass
+
+    await server.start()
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()